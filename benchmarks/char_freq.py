@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""Compare loading and looking up the character frequency TSV and binary index.
+
+    python benchmarks/char_freq.py
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(
+    1, os.path.join(os.path.dirname(__file__), "..", "src", "AnkiChinese")
+)
+
+from freq import INDEX_PATH, TSV_PATH, FrequencyIndex, read_tsv
+
+
+def best_of(repeat, func) -> tuple:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def lookup_all(get, chars):
+    for hanzi in chars:
+        get(hanzi)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if not os.path.exists(INDEX_PATH):
+        print("No index found, run python src/AnkiChinese/freq.py first")
+        return 1
+
+    tsv_load, freq_map = best_of(args.repeat, lambda: read_tsv(TSV_PATH))
+    index_load, index = best_of(args.repeat, lambda: FrequencyIndex.load(INDEX_PATH))
+
+    # Known characters plus as many unknown ones, like a deck of rare characters
+    chars = [hanzi for hanzi in freq_map if len(hanzi) == 1]
+    chars += [chr(0x20000 + i) for i in range(len(chars))]
+
+    def dict_get(hanzi):
+        return freq_map.get(hanzi, (None, None))
+
+    dict_lookup, _ = best_of(args.repeat, lambda: lookup_all(dict_get, chars))
+    index_lookup, _ = best_of(args.repeat, lambda: lookup_all(index.get, chars))
+
+    mismatches = [
+        hanzi for hanzi in chars if dict_get(hanzi) != index.get(hanzi)
+    ]
+
+    print(f"{len(index)} character(s), {len(chars)} lookup(s)")
+    print(f"{'':>6}  {'load':>10}  {'lookup':>12}")
+    for name, load, lookup in (
+        ("tsv", tsv_load, dict_lookup),
+        ("index", index_load, index_lookup),
+    ):
+        print(
+            f"{name:>6}: {load * 1000:7.2f} ms  "
+            f"{lookup / len(chars) * 1e9:8.1f} ns/char"
+        )
+    print(f"{len(mismatches)} mismatch(es)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
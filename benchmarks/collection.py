@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Compare reading update mode's notes with ankipandas and with targeted SQL queries.
+
+A synthetic collection is built with genanki in a temporary folder: the target
+deck with a subdeck, plus unrelated decks holding most of the cards. Each
+reader runs in its own process so that peak RSS is separate. ankipandas is
+no longer a dependency, its reader is skipped unless it is installed. Finally
+every note in the target deck is changed and a tenth as many are added with
+the bulk writer, and the same is done through update mode's update_anki, which
+also copies audio and records the refresh log:
+
+    python benchmarks/collection.py
+    python benchmarks/collection.py --notes 75000
+"""
+import argparse
+import importlib.util
+import itertools
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    1, os.path.join(os.path.dirname(__file__), "..", "src", "AnkiChinese")
+)
+
+import genanki
+
+import export
+from ankidb import AnkiCollection, RefreshLog, refresh_log_path
+from interface import Interface
+
+READERS = ["ankipandas", "sql", "write", "update"]
+DECK_NAME = "Chinese"
+MODEL_NAME = "AnkiChinese"
+
+
+def build_collection(path, num_notes):
+    model = export.gen_model()
+    other_model = genanki.Model(
+        1607392319,
+        "Basic",
+        fields=[{"name": "Front"}, {"name": "Back"}],
+        templates=[{"name": "Card 1", "qfmt": "{{Front}}", "afmt": "{{Back}}"}],
+    )
+    decks = [
+        genanki.Deck(1, DECK_NAME),
+        genanki.Deck(2, DECK_NAME + "::HSK 1"),
+        genanki.Deck(3, "Japanese"),
+        genanki.Deck(4, "Geography"),
+    ]
+    # A tenth of the notes are in the target deck, the rest elsewhere
+    for i in range(num_notes):
+        if i % 10 == 0:
+            data = {field: f"{field} {i}" for field in export.FIELDS}
+            data["Hanzi"] = chr(0x4E00 + i // 10)
+            decks[i // 10 % 2].add_note(export.gen_note(model, data))
+        else:
+            decks[2 + i % 2].add_note(
+                genanki.Note(other_model, [f"front {i}", f"back {i}"])
+            )
+    conn = sqlite3.connect(path)
+    timestamp = time.time()
+    genanki.Package(decks).write_to_db(
+        conn.cursor(), timestamp, itertools.count(int(timestamp * 1000))
+    )
+    conn.commit()
+    conn.close()
+
+
+def read_ankipandas(path) -> list:
+    from ankipandas import Collection
+
+    col = Collection(path)
+    cards = col.cards.merge_notes()
+    cards_in_deck = cards[cards["cdeck"].str.startswith(DECK_NAME)]
+    notes_in_deck = col.notes[col.notes.nid.isin(cards_in_deck.nid)]
+    selec = notes_in_deck.query(f"nmodel == '{MODEL_NAME}'").copy()
+    return selec.fields_as_columns().nfld_Hanzi.to_list()
+
+
+def read_sql(path) -> list:
+    col = AnkiCollection(path)
+    model_id = col.deck_models(DECK_NAME)[MODEL_NAME]
+    index = col.field_names(model_id).index("Hanzi")
+    return [fields[index] for _, fields in col.notes(DECK_NAME, model_id)]
+
+
+def write_sql(path) -> list:
+    col = AnkiCollection(path)
+    model_id = col.deck_models(DECK_NAME)[MODEL_NAME]
+    notes = col.notes(DECK_NAME, model_id)
+    changed = {nid: [value + "!" for value in fields] for nid, fields in notes}
+    added = [
+        [chr(0x9000 + i)] + fields[1:] for i, (_, fields) in enumerate(notes[::10])
+    ]
+    col.write_notes(model_id, DECK_NAME, changed, added)
+    return [fields[0] for fields in changed.values()] + [f[0] for f in added]
+
+
+class QuietInterface(Interface):
+    def confirm(self, msg) -> bool:
+        return True
+
+
+def update_anki(path) -> list:
+    col = AnkiCollection(path)
+    model_id = col.deck_models(DECK_NAME)[MODEL_NAME]
+    field_names = col.field_names(model_id)
+    notes = col.notes(DECK_NAME, model_id)
+    audio_dir = os.path.join(os.path.dirname(path), "audio")
+    os.makedirs(audio_dir, exist_ok=True)
+    with open(os.path.join(audio_dir, "ma1.mp3"), "wb") as f:
+        f.write(os.urandom(20000))
+    results = [
+        dict(zip(field_names, fields), Definition="changed", Audio="[sound:ma1.mp3]")
+        for _, fields in notes
+    ]
+    results += [
+        dict(data, Hanzi=chr(0x9000 + i)) for i, data in enumerate(results[::10])
+    ]
+    export.update_anki(
+        QuietInterface(), results, col, DECK_NAME, MODEL_NAME, audio_dir
+    )
+
+    # Everything update mode does after writing the notes must have happened
+    col = AnkiCollection(path)
+    if not os.path.isfile(os.path.join(col.media_dir(), "ma1.mp3")):
+        raise RuntimeError("audio was not copied into the collection media folder")
+    log = RefreshLog(refresh_log_path(path))
+    hanzi = [data["Hanzi"] for data in results]
+    if log.stale(model_id, hanzi, 1, export.PARSER_VERSION):
+        raise RuntimeError("updated characters are missing from the refresh log")
+    return col.hanzi(DECK_NAME, model_id)
+
+
+def run(reader, path):
+    start = time.perf_counter()
+    read = {
+        "ankipandas": read_ankipandas,
+        "sql": read_sql,
+        "write": write_sql,
+        "update": update_anki,
+    }
+    hanzi = read[reader](path)
+    elapsed = time.perf_counter() - start
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    print(elapsed, peak, len(set(hanzi)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=50000)
+    parser.add_argument("--run", choices=READERS, help=argparse.SUPPRESS)
+    parser.add_argument("--build", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.build:
+        build_collection(args.path, args.notes)
+        return 0
+    if args.run:
+        run(args.run, args.path)
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "collection.anki2")
+        # Linux counts the memory of the parent towards a child's peak RSS, so
+        # the large collection is built in a child as well
+        subprocess.run(
+            [sys.executable, __file__, "--build", "--path", path]
+            + ["--notes", str(args.notes)],
+            check=True,
+        )
+        conn = sqlite3.connect(path)
+        (cards,) = conn.execute("SELECT count(*) FROM cards").fetchone()
+        conn.close()
+        print(f"{args.notes} note(s), {cards} card(s)")
+        for reader in READERS:
+            if reader == "ankipandas" and importlib.util.find_spec(reader) is None:
+                print(f"{reader:>10}: skipped, not installed")
+                continue
+            result = subprocess.run(
+                [sys.executable, __file__, "--run", reader, "--path", path],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            elapsed, peak, found = map(float, result.stdout.split())
+            print(
+                f"{reader:>10}: {elapsed:7.3f} s, "
+                f"peak RSS {peak / 1024 / 1024:7.1f} MiB, "
+                f"{int(found)} note(s)"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
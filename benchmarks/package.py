@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""Compare write time, peak memory and size of genanki's and export's package writers.
+
+A synthetic deck and random MP3-sized media files are created in a temporary
+folder, then each writer runs in its own process so that peak RSS is separate:
+
+    python benchmarks/package.py
+    python benchmarks/package.py --notes 20000 --media 1500
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(
+    1, os.path.join(os.path.dirname(__file__), "..", "src", "AnkiChinese")
+)
+
+import genanki
+
+import export
+
+WRITERS = ["genanki", "export"]
+
+
+def build_package(workdir, num_notes) -> genanki.Package:
+    model = export.gen_model()
+    deck = genanki.Deck(2085137232, "benchmark")
+    media = sorted(os.listdir(os.path.join(workdir, "media")))
+    for i in range(num_notes):
+        data = {field: f"{field} {i} " * 10 for field in export.FIELDS}
+        data["Hanzi"] = chr(0x4E00 + i)
+        data["Audio"] = f"[sound:{media[i % len(media)]}]"
+        deck.add_note(export.gen_note(model, data))
+    return genanki.Package(
+        deck, [os.path.join(workdir, "media", name) for name in media]
+    )
+
+
+def run(writer, workdir, num_notes):
+    package = build_package(workdir, num_notes)
+    output = os.path.join(workdir, writer + ".apkg")
+    start = time.perf_counter()
+    if writer == "genanki":
+        package.write_to_file(output)
+    else:
+        export.write_package(package, output)
+    elapsed = time.perf_counter() - start
+    # Kilobytes on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        peak *= 1024
+    print(elapsed, peak, os.path.getsize(output))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--notes", type=int, default=5000)
+    parser.add_argument("--media", type=int, default=1500)
+    parser.add_argument("--media-size", type=int, default=20000)
+    parser.add_argument("--run", choices=WRITERS, help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run(args.run, args.workdir, args.notes)
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        os.mkdir(os.path.join(workdir, "media"))
+        for i in range(args.media):
+            with open(os.path.join(workdir, "media", f"s{i}.mp3"), "wb") as f:
+                f.write(os.urandom(args.media_size))
+
+        print(f"{args.notes} note(s), {args.media} media file(s)")
+        for writer in WRITERS:
+            result = subprocess.run(
+                [sys.executable, __file__, "--run", writer, "--workdir", workdir]
+                + ["--notes", str(args.notes)],
+                check=True,
+                capture_output=True,
+                text=True,
+            )
+            elapsed, peak, size = map(float, result.stdout.split())
+            print(
+                f"{writer:>8}: {elapsed:7.3f} s, "
+                f"peak RSS {peak / 1024 / 1024:7.1f} MiB, "
+                f"{size / 1024 / 1024:7.1f} MiB"
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
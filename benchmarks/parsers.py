@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Compare the speed and output of the HTML parsers on a corpus of stored pages.
+
+The corpus is read from the page cache filled by normal runs, or from a folder
+of <hanzi>.html files:
+
+    python benchmarks/parsers.py
+    python benchmarks/parsers.py --pages-dir pages/
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(
+    1, os.path.join(os.path.dirname(__file__), "..", "src", "AnkiChinese")
+)
+
+from cache import default_cache_dir
+from parsing import PARSERS, parse_word
+
+
+def load_corpus(args) -> list:
+    if args.pages_dir:
+        corpus = []
+        for file in sorted(os.listdir(args.pages_dir)):
+            if file.endswith(".html"):
+                with open(os.path.join(args.pages_dir, file), encoding="utf8") as f:
+                    corpus.append((file[: -len(".html")], f.read()))
+        return corpus
+
+    db = sqlite3.connect(os.path.join(args.cache_dir, "pages.sqlite"))
+    corpus = db.execute("SELECT hanzi, html FROM pages ORDER BY hanzi").fetchall()
+    db.close()
+    return corpus
+
+
+def parse_all(corpus, parser) -> list:
+    records = []
+    for hanzi, content in corpus:
+        try:
+            records.append(parse_word(content, hanzi, parser))
+        except Exception as e:
+            records.append(repr(e))
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cache-dir", default=default_cache_dir())
+    parser.add_argument("--pages-dir", default=None)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args)
+    if not corpus:
+        print("No pages found, run ankichinese first to fill the page cache")
+        return 1
+    size = sum(len(content) for _, content in corpus)
+    print(f"{len(corpus)} page(s), {size / 1024 / 1024:.1f} MiB")
+
+    results = {}
+    for name in PARSERS:
+        best = float("inf")
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            results[name] = parse_all(corpus, name)
+            best = min(best, time.perf_counter() - start)
+        print(
+            f"{name:>10}: {best:8.3f} s total, "
+            f"{best / len(corpus) * 1000:8.3f} ms/page"
+        )
+
+    reference = results[PARSERS[-1]]
+    for name in PARSERS[:-1]:
+        mismatches = [
+            hanzi
+            for (hanzi, _), a, b in zip(corpus, results[name], reference)
+            if a != b
+        ]
+        print(f"{name} vs {PARSERS[-1]}: {len(mismatches)} mismatch(es)")
+        for hanzi in mismatches[:10]:
+            print(f"  {hanzi}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
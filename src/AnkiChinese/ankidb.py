@@ -0,0 +1,437 @@
+import glob
+import hashlib
+import html
+import json
+import os
+import random
+import re as regex
+import sqlite3
+import string
+import sys
+import time
+
+# Anki separates fields in notes.flds and, in newer collections, deck names
+FIELD_SEPARATOR = "\x1f"
+
+# Characters of the base 91 note GUIDs that Anki generates
+_GUID_CHARS = string.ascii_letters + string.digits + "!#$%&()*+,-./:;<=>?@[]^_`{|}~"
+
+_MEDIA_TAG = regex.compile(
+    r"<img[^>]+src=[\"']?([^\"'>]+)[\"']?[^>]*>", regex.IGNORECASE
+)
+_COMMENT = regex.compile(r"<!--.*?-->", regex.DOTALL)
+_TAG = regex.compile(r"<.*?>", regex.DOTALL)
+
+
+def anki_dirs() -> list:
+    """Return the folders that Anki keeps its profiles in on this platform."""
+    home = os.path.expanduser("~")
+    if os.name == "nt":
+        return [os.path.join(os.environ.get("APPDATA", home), "Anki2")]
+    if sys.platform == "darwin":
+        return [os.path.join(home, "Library", "Application Support", "Anki2")]
+    return [
+        os.path.join(
+            os.environ.get("XDG_DATA_HOME", os.path.join(home, ".local", "share")),
+            "Anki2",
+        ),
+        os.path.join(home, "Documents", "Anki2"),
+    ]
+
+
+def find_collection() -> str:
+    """Return the path of the only Anki profile's collection.
+
+    Raises ValueError if there is no profile or more than one.
+    """
+    found = []
+    for anki_dir in anki_dirs():
+        found += sorted(glob.glob(os.path.join(anki_dir, "*", "collection.anki2")))
+    if not found:
+        raise ValueError("No Anki collection found, is Anki installed?")
+    if len(found) > 1:
+        raise ValueError(
+            "Found more than one Anki profile, choose one of: " + ", ".join(found)
+        )
+    return found[0]
+
+
+def strip_html(text) -> str:
+    """Strip HTML from a field like Anki does for sorting, keeping image names."""
+    text = _MEDIA_TAG.sub(r" \1 ", text)
+    text = _TAG.sub("", _COMMENT.sub("", text))
+    return html.unescape(text).strip()
+
+
+def field_checksum(text) -> int:
+    """Return Anki's checksum of a field, used to find duplicate notes."""
+    return int(hashlib.sha1(strip_html(text).encode("utf8")).hexdigest()[:8], 16)
+
+
+def guid() -> str:
+    """Return a random note GUID in Anki's format."""
+    value = random.getrandbits(64)
+    chars = []
+    while value:
+        value, index = divmod(value, len(_GUID_CHARS))
+        chars.append(_GUID_CHARS[index])
+    return "".join(reversed(chars))
+
+
+def refresh_log_path(collection_path) -> str:
+    """Return the refresh log kept next to a collection."""
+    return os.path.join(os.path.dirname(collection_path), "ankichinese_refresh.sqlite")
+
+
+def _proto_varints(blob) -> dict:
+    """Return the integer fields of a protobuf message by field number."""
+    values = {}
+    pos = 0
+
+    def varint():
+        nonlocal pos
+        result = shift = 0
+        while True:
+            byte = blob[pos]
+            pos += 1
+            result |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return result
+
+    while pos < len(blob):
+        key = varint()
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            values[number] = varint()
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            pos += varint()
+        elif wire_type == 5:
+            pos += 4
+        else:
+            break
+    return values
+
+
+def _unicase(a, b) -> int:
+    # Newer collections index deck and note type names with this collation
+    a, b = a.casefold(), b.casefold()
+    return (a > b) - (a < b)
+
+
+class AnkiCollection:
+    """Read and write the notes of one deck and model in an Anki collection.
+
+    Only the rows that are needed are queried from the collection's SQLite
+    database. Both the legacy schema, which keeps decks and models as JSON in
+    the col table, and the newer decks, notetypes and fields tables are read.
+    Anki must be closed while notes are written.
+
+    Args:
+        path (str): Path of collection.anki2, found automatically if None.
+    """
+
+    def __init__(self, path=None):
+        self.path = path or find_collection()
+        # The GUI reads decks on the Tk thread and updates notes on a worker
+        # thread, never both at once
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.create_collation("unicase", _unicase)
+        self.legacy = not self.has_table("notetypes")
+
+    def has_table(self, name) -> bool:
+        return bool(
+            self.db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                (name,),
+            ).fetchone()
+        )
+
+    def next_position(self) -> int:
+        """Return the position Anki gives the next new card."""
+        # Collection settings moved from col.conf to the config table in schema 14
+        if self.has_table("config"):
+            row = self.db.execute(
+                "SELECT val FROM config WHERE key = 'nextPos'"
+            ).fetchone()
+            return json.loads(row[0]) if row else 1
+        (conf,) = self.db.execute("SELECT conf FROM col").fetchone()
+        return json.loads(conf).get("nextPos", 1)
+
+    def set_next_position(self, position, mod):
+        if self.has_table("config"):
+            self.db.execute(
+                "INSERT OR REPLACE INTO config (key, usn, mtime_secs, val) "
+                "VALUES ('nextPos', -1, ?, ?)",
+                (mod, json.dumps(position).encode("utf8")),
+            )
+            return
+        (conf,) = self.db.execute("SELECT conf FROM col").fetchone()
+        conf = json.loads(conf)
+        conf["nextPos"] = position
+        self.db.execute("UPDATE col SET conf = ?", (json.dumps(conf),))
+
+    def close(self):
+        self.db.close()
+
+    def media_dir(self) -> str:
+        """Return the profile's media folder, kept next to the collection."""
+        return os.path.splitext(self.path)[0] + ".media"
+
+    def decks(self) -> dict:
+        """Return a mapping of deck id -> full name, e.g. "Chinese::HSK 1"."""
+        if self.legacy:
+            (decks,) = self.db.execute("SELECT decks FROM col").fetchone()
+            return {
+                int(did): deck["name"] for did, deck in json.loads(decks).items()
+            }
+        return {
+            did: name.replace(FIELD_SEPARATOR, "::")
+            for did, name in self.db.execute("SELECT id, name FROM decks")
+        }
+
+    def models(self) -> dict:
+        """Return a mapping of model id -> (name, field names in order)."""
+        if self.legacy:
+            (models,) = self.db.execute("SELECT models FROM col").fetchone()
+            return {
+                int(mid): (
+                    model["name"],
+                    [f["name"] for f in sorted(model["flds"], key=lambda f: f["ord"])],
+                )
+                for mid, model in json.loads(models).items()
+            }
+        fields = {}
+        for mid, name in self.db.execute(
+            "SELECT ntid, name FROM fields ORDER BY ntid, ord"
+        ):
+            fields.setdefault(mid, []).append(name)
+        return {
+            mid: (name, fields.get(mid, []))
+            for mid, name in self.db.execute("SELECT id, name FROM notetypes")
+        }
+
+    def deck_names(self) -> list:
+        """Return the names of decks that hold cards, and of their parent decks."""
+        decks = self.decks()
+        names = set()
+        for (did,) in self.db.execute("SELECT DISTINCT did FROM cards"):
+            if did in decks:
+                parts = decks[did].split("::")
+                names.update("::".join(parts[:i]) for i in range(1, len(parts) + 1))
+        return sorted(names)
+
+    def deck_ids(self, deck_name) -> list:
+        """Return the ids of a deck and its subdecks."""
+        return [
+            did
+            for did, name in self.decks().items()
+            if name == deck_name or name.startswith(deck_name + "::")
+        ]
+
+    def note_rows(self, deck_name, columns, model_id=None) -> list:
+        """Query columns of the notes with cards in a deck or its subdecks.
+
+        Cards moved to a filtered deck count towards their original deck.
+        """
+        dids = self.deck_ids(deck_name)
+        if not dids:
+            return []
+        placeholders = ", ".join("?" * len(dids))
+        query = (
+            f"SELECT {columns} FROM notes WHERE id IN (SELECT nid FROM cards "
+            f"WHERE did IN ({placeholders}) OR odid IN ({placeholders}))"
+        )
+        params = dids + dids
+        if model_id is not None:
+            query += " AND mid = ?"
+            params.append(model_id)
+        return self.db.execute(query, params).fetchall()
+
+    def deck_models(self, deck_name) -> dict:
+        """Return a mapping of name -> id of the models used in a deck."""
+        models = self.models()
+        return {
+            models[mid][0]: mid
+            for (mid,) in self.note_rows(deck_name, "DISTINCT mid")
+            if mid in models
+        }
+
+    def field_names(self, model_id) -> list:
+        return self.models()[model_id][1]
+
+    def notes(self, deck_name, model_id) -> list:
+        """Return (note id, field values) of a model's notes in a deck."""
+        return [
+            (nid, flds.split(FIELD_SEPARATOR))
+            for nid, flds in self.note_rows(deck_name, "id, flds", model_id)
+        ]
+
+    def hanzi(self, deck_name, model_id=None) -> list:
+        """Return the Hanzi field of notes in a deck, for models that have one."""
+        models = self.models()
+        if model_id is None:
+            mids = list(self.deck_models(deck_name).values())
+        else:
+            mids = [model_id]
+        hanzi = []
+        for mid in mids:
+            names = models[mid][1]
+            if "Hanzi" not in names:
+                continue
+            index = names.index("Hanzi")
+            hanzi += [fields[index] for _, fields in self.notes(deck_name, mid)]
+        return hanzi
+
+    def card_layout(self, model_id) -> tuple:
+        """Return the sort field index and card template ords of a model."""
+        if self.legacy:
+            (models,) = self.db.execute("SELECT models FROM col").fetchone()
+            model = json.loads(models)[str(model_id)]
+            sort_field = model.get("sortf", 0)
+            cloze = model.get("type") == 1
+            ords = sorted(template["ord"] for template in model["tmpls"])
+        else:
+            (config,) = self.db.execute(
+                "SELECT config FROM notetypes WHERE id = ?", (model_id,)
+            ).fetchone()
+            # NotetypeConfig: 1 is the kind (1 for cloze), 2 the sort field
+            config = _proto_varints(config or b"")
+            sort_field = config.get(2, 0)
+            cloze = config.get(1) == 1
+            ords = [
+                ord_
+                for (ord_,) in self.db.execute(
+                    "SELECT ord FROM templates WHERE ntid = ? ORDER BY ord",
+                    (model_id,),
+                )
+            ]
+        # Cloze notes get a card per cloze number, this adds the first
+        return sort_field, [0] if cloze else ords
+
+    def write_notes(self, model_id, deck_name, changed, added) -> list:
+        """Update and add notes, with a card per template for added notes.
+
+        Everything is written in a single transaction, so the collection is left
+        untouched if anything fails. Written notes and cards are marked for the
+        next sync, and the position of the next new card is moved past the
+        added ones.
+
+        Args:
+            model_id (int): Model of the notes.
+            deck_name (str): Deck to add cards of new notes to.
+            changed (dict): Note id -> new field values of existing notes.
+            added (list): Field values of new notes.
+
+        Returns:
+            list: Ids of the added notes.
+        """
+        deck_id = {name: did for did, name in self.decks().items()}[deck_name]
+        sort_field, ords = self.card_layout(model_id)
+        now = time.time()
+        mod = int(now)
+
+        def note_columns(fields):
+            flds = FIELD_SEPARATOR.join(fields)
+            return flds, strip_html(fields[sort_field]), field_checksum(fields[0])
+
+        (max_nid,) = self.db.execute("SELECT max(id) FROM notes").fetchone()
+        (max_cid,) = self.db.execute("SELECT max(id) FROM cards").fetchone()
+        (max_due,) = self.db.execute(
+            "SELECT max(due) FROM cards WHERE type = 0"
+        ).fetchone()
+        # Ids are millisecond timestamps, kept unique by counting up
+        first_nid = max(int(now * 1000), (max_nid or 0) + 1)
+        first_cid = max(int(now * 1000), (max_cid or 0) + 1)
+        first_due = max(self.next_position(), (max_due or 0) + 1)
+
+        nids = [first_nid + i for i in range(len(added))]
+        notes = [
+            (nid, guid(), model_id, mod, -1, "", *note_columns(fields), 0, "")
+            for nid, fields in zip(nids, added)
+        ]
+        cards = [
+            (first_cid + i * len(ords) + j, nid, deck_id, ord_, mod, -1)
+            + (0, 0, first_due + i, 0, 0, 0, 0, 0, 0, 0, 0, "")
+            for i, nid in enumerate(nids)
+            for j, ord_ in enumerate(ords)
+        ]
+        with self.db:
+            self.db.executemany(
+                "UPDATE notes SET flds = ?, sfld = ?, csum = ?, mod = ?, usn = -1 "
+                "WHERE id = ?",
+                [
+                    (*note_columns(fields), mod, nid)
+                    for nid, fields in changed.items()
+                ],
+            )
+            self.db.executemany(
+                "INSERT INTO notes (id, guid, mid, mod, usn, tags, flds, sfld, "
+                "csum, flags, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                notes,
+            )
+            self.db.executemany(
+                "INSERT INTO cards (id, nid, did, ord, mod, usn, type, queue, "
+                "due, ivl, factor, reps, lapses, left, odue, odid, flags, data) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                cards,
+            )
+            if added:
+                self.set_next_position(first_due + len(added), mod)
+            self.db.execute("UPDATE col SET mod = ?", (int(now * 1000),))
+        return nids
+
+
+class RefreshLog:
+    """SQLite record of when characters of a model were last written by update mode.
+
+    Kept in its own file next to the collection, so that note fields and the
+    collection's schema are left alone.
+
+    Args:
+        path (str): Log file, created if missing.
+    """
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS refreshed (
+                model_id INTEGER NOT NULL,
+                hanzi TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                refreshed_at REAL NOT NULL,
+                PRIMARY KEY (model_id, hanzi)
+            )"""
+        )
+        self.db.commit()
+
+    def stale(self, model_id, hanzi, max_age, parser_version) -> list:
+        """Return the characters of hanzi that need refreshing.
+
+        A character is stale if it was never refreshed, was refreshed more than
+        max_age days ago or was parsed by another parser version.
+        """
+        oldest_fresh = time.time() - max_age * 24 * 60 * 60
+        fresh = {
+            row[0]
+            for row in self.db.execute(
+                """SELECT hanzi FROM refreshed
+                WHERE model_id = ? AND parser_version = ? AND refreshed_at >= ?""",
+                (model_id, parser_version, oldest_fresh),
+            )
+        }
+        return [char for char in hanzi if char not in fresh]
+
+    def record(self, model_id, hanzi, parser_version):
+        now = time.time()
+        with self.db:
+            self.db.executemany(
+                """INSERT OR REPLACE INTO refreshed
+                (model_id, hanzi, parser_version, refreshed_at) VALUES (?, ?, ?, ?)""",
+                [(model_id, char, parser_version, now) for char in hanzi],
+            )
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,214 @@
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import re as regex
+import tempfile
+from urllib.parse import urlsplit
+
+import httpx
+
+from options import default_audio_dir
+
+# Pinyin audio sources in order of preference, neutral tones are only on the second
+AUDIO_URLS = [
+    "https://cdn.yoyochinese.com/audio/pychart/{}.mp3",
+    "https://www.purpleculture.net/mp3/{}.mp3",
+]
+
+# Maximum number of simultaneous downloads from each host
+HOST_LIMITS = {
+    "cdn.yoyochinese.com": 4,
+    "www.purpleculture.net": 2,
+}
+
+
+_SYLLABLE = regex.compile(r"[a-z]+[1-5]")
+
+
+def all_syllables() -> list:
+    """Return every tone-syllable used in the character frequency table.
+
+    Syllables are in the audio file format, e.g. "lv4" for lü4 and "ma5" for
+    the neutral tone ma.
+    """
+    file_path = os.path.join(os.path.dirname(__file__), "data", "char_freq.tsv")
+    syllables = set()
+    with open(file_path, newline="", encoding="gb2312", errors="replace") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            # Skip header/comment lines
+            if not row[0].strip().isdigit() or len(row) < 5:
+                continue
+
+            for pinyin in row[4].split("/"):
+                pinyin = pinyin.strip().lower().replace("u:", "v")
+                if pinyin and not pinyin[-1].isdigit():
+                    pinyin += "5"
+                if _SYLLABLE.fullmatch(pinyin):
+                    syllables.add(pinyin)
+    return sorted(syllables)
+
+
+def write_atomic(file_path, content):
+    """Write content to file_path so that readers never see a partial file."""
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(file_path), suffix=".part"
+    )
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class AudioStore:
+    """Shared folder of pinyin audio with a manifest of where it came from.
+
+    The manifest maps each syllable to its file name, size, SHA-256 hash and
+    source URL.
+
+    Args:
+        audio_dir (str): Folder holding the audio files, created if missing.
+    """
+
+    def __init__(self, audio_dir=None):
+        self.audio_dir = audio_dir or default_audio_dir()
+        os.makedirs(self.audio_dir, exist_ok=True)
+        self.manifest_path = os.path.join(self.audio_dir, "manifest.json")
+        try:
+            with open(self.manifest_path, encoding="utf8") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            self.manifest = {}
+
+    def file_path(self, pinyin_tone) -> str:
+        return os.path.join(self.audio_dir, f"{pinyin_tone}.mp3")
+
+    def contains(self, pinyin_tone) -> bool:
+        return os.path.exists(self.file_path(pinyin_tone))
+
+    def add(self, pinyin_tone, content, source) -> str:
+        file_path = self.file_path(pinyin_tone)
+        write_atomic(file_path, content)
+        self.manifest[pinyin_tone] = {
+            "file": os.path.basename(file_path),
+            "size": len(content),
+            "sha256": hashlib.sha256(content).hexdigest(),
+            "source": source,
+        }
+        return file_path
+
+    def save(self):
+        write_atomic(
+            self.manifest_path,
+            json.dumps(self.manifest, indent=2, sort_keys=True).encode("utf8"),
+        )
+
+
+class AudioDownloader:
+    """Download pinyin audio in the background of scraping.
+
+    Downloads share one pooled HTTP client, are limited per host, and requests
+    for a syllable that is already downloading wait for that download instead of
+    starting another.
+
+    Args:
+        store (AudioStore): Store to save audio files in.
+        host_limits (dict): Maximum number of simultaneous downloads per host.
+    """
+
+    def __init__(self, store, host_limits=HOST_LIMITS):
+        self.store = store
+        self.host_limits = host_limits
+        self.semaphores = {}
+        self.client = None
+        self.in_flight = {}
+        self.tasks = {}
+
+    async def __aenter__(self):
+        self.semaphores = {
+            host: asyncio.Semaphore(limit) for host, limit in self.host_limits.items()
+        }
+        self.client = httpx.AsyncClient(follow_redirects=True, timeout=30)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        for task in list(self.tasks.values()) + list(self.in_flight.values()):
+            task.cancel()
+        await self.client.aclose()
+        self.store.save()
+
+    async def download(self, pinyin_tone) -> str:
+        """Download the audio for pinyin_tone if missing and return its path."""
+        if self.store.contains(pinyin_tone):
+            return self.store.file_path(pinyin_tone)
+
+        task = self.in_flight.get(pinyin_tone)
+        if task is None:
+            task = asyncio.ensure_future(self._download(pinyin_tone))
+            self.in_flight[pinyin_tone] = task
+            task.add_done_callback(lambda _: self.in_flight.pop(pinyin_tone, None))
+        return await asyncio.shield(task)
+
+    async def _download(self, pinyin_tone) -> str:
+        for url in AUDIO_URLS:
+            host = urlsplit(url).hostname
+            source = url.format(pinyin_tone)
+            async with self.semaphores.setdefault(host, asyncio.Semaphore(1)):
+                r = await self.client.get(source)
+            if r.status_code == 404:
+                continue
+            r.raise_for_status()
+            return self.store.add(pinyin_tone, r.content, source)
+        raise FileNotFoundError(f"No audio found for {pinyin_tone}")
+
+    def schedule(self, pinyin_tone):
+        """Start downloading pinyin_tone without waiting for it."""
+        if pinyin_tone not in self.tasks:
+            self.tasks[pinyin_tone] = asyncio.ensure_future(
+                self.download(pinyin_tone)
+            )
+
+    async def wait(self) -> dict:
+        """Wait for all scheduled downloads, return errors keyed by syllable."""
+        results = await asyncio.gather(*self.tasks.values(), return_exceptions=True)
+        return {
+            pinyin_tone: result
+            for pinyin_tone, result in zip(self.tasks.keys(), results)
+            if isinstance(result, BaseException)
+        }
+
+
+async def prefetch(syllables, store, requests_at_once, interface) -> dict:
+    """Download every missing syllable into store.
+
+    Returns errors keyed by syllable.
+    """
+    missing = [
+        pinyin_tone for pinyin_tone in syllables if not store.contains(pinyin_tone)
+    ]
+    host_limits = {host: requests_at_once for host in HOST_LIMITS}
+    errors = {}
+
+    async def download(downloader, pinyin_tone):
+        try:
+            await downloader.download(pinyin_tone)
+        except Exception as e:
+            errors[pinyin_tone] = e
+        await interface.step_pbar()
+
+    interface.print(
+        f"{len(syllables) - len(missing)} of {len(syllables)} "
+        "syllable(s) already stored"
+    )
+    interface.start_pbar(len(missing))
+    async with AudioDownloader(store, host_limits) as downloader:
+        await asyncio.gather(
+            *(download(downloader, pinyin_tone) for pinyin_tone in missing)
+        )
+    interface.finish_pbar()
+    return errors
@@ -0,0 +1,132 @@
+import json
+import os
+import sqlite3
+import sys
+import time
+from typing import Optional
+
+# Default number of days a cached page stays fresh
+DEFAULT_MAX_AGE = 30
+
+
+def default_cache_dir() -> str:
+    """Return the per-user cache directory for AnkiChinese."""
+    if os.name == "nt":
+        base = os.environ.get("LOCALAPPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Caches")
+    else:
+        base = os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache"))
+    return os.path.join(base, "ankichinese")
+
+
+class PageCache:
+    """SQLite cache of rendered ArchChinese pages keyed by hanzi.
+
+    Args:
+        cache_dir (str): Directory holding the cache file, created if missing.
+        max_age (float): Number of days before a cached page is refetched.
+    """
+
+    def __init__(self, cache_dir=None, max_age=DEFAULT_MAX_AGE):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_age = max_age
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, "pages.sqlite"))
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS pages (
+                hanzi TEXT PRIMARY KEY,
+                html TEXT NOT NULL,
+                fetched_at REAL NOT NULL
+            )"""
+        )
+        self.db.commit()
+
+    def _oldest_fresh(self) -> float:
+        return time.time() - self.max_age * 24 * 60 * 60
+
+    def contains(self, hanzi) -> bool:
+        row = self.db.execute(
+            "SELECT 1 FROM pages WHERE hanzi = ? AND fetched_at >= ?",
+            (hanzi, self._oldest_fresh()),
+        ).fetchone()
+        return row is not None
+
+    def get(self, hanzi) -> Optional[str]:
+        """Return the cached page for hanzi, or None if missing or expired."""
+        row = self.db.execute(
+            "SELECT html FROM pages WHERE hanzi = ? AND fetched_at >= ?",
+            (hanzi, self._oldest_fresh()),
+        ).fetchone()
+        return row[0] if row else None
+
+    def put(self, hanzi, html):
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages (hanzi, html, fetched_at) VALUES (?, ?, ?)",
+            (hanzi, html, time.time()),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class RecordCache:
+    """SQLite cache of complete parsed records keyed by hanzi.
+
+    Records are stored before any truncation so that output limits can change
+    without scraping again. Records from a different parser version are ignored.
+
+    Args:
+        cache_dir (str): Directory holding the cache file, created if missing.
+        max_age (float): Number of days before a cached record is scraped again.
+        parser_version (int): Version of the parser producing the records.
+    """
+
+    def __init__(self, cache_dir=None, max_age=DEFAULT_MAX_AGE, parser_version=0):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_age = max_age
+        self.parser_version = parser_version
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(self.cache_dir, "records.sqlite"))
+        self.db.execute(
+            """CREATE TABLE IF NOT EXISTS records (
+                hanzi TEXT PRIMARY KEY,
+                record TEXT NOT NULL,
+                parser_version INTEGER NOT NULL,
+                scraped_at REAL NOT NULL
+            )"""
+        )
+        self.db.commit()
+
+    def _oldest_fresh(self) -> float:
+        return time.time() - self.max_age * 24 * 60 * 60
+
+    def contains(self, hanzi) -> bool:
+        return self.get(hanzi) is not None
+
+    def get(self, hanzi) -> Optional[dict]:
+        """Return the cached record for hanzi, or None if missing, expired or
+        produced by another parser version."""
+        row = self.db.execute(
+            """SELECT record FROM records
+            WHERE hanzi = ? AND parser_version = ? AND scraped_at >= ?""",
+            (hanzi, self.parser_version, self._oldest_fresh()),
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, hanzi, record):
+        self.db.execute(
+            """INSERT OR REPLACE INTO records
+            (hanzi, record, parser_version, scraped_at) VALUES (?, ?, ?, ?)""",
+            (
+                hanzi,
+                json.dumps(record, ensure_ascii=False),
+                self.parser_version,
+                time.time(),
+            ),
+        )
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
@@ -1,17 +1,65 @@
 import sys
 import os.path
+import builtins
+import time
 
 sys.path.insert(1, os.path.dirname(__file__))  # Allows python to find other modules
 
-import scraper
-import export
+# Only lightweight modules are imported up front, the scraper, exporters and
+# their dependencies are imported once the arguments are known to need them
+from cache import default_cache_dir, DEFAULT_MAX_AGE
+from options import ENGINES, WAIT_UNTIL, PARSERS, default_audio_dir
+from journal import default_journal_path, remove_journal
 from interface import Interface
+from ankidb import AnkiCollection, RefreshLog, refresh_log_path
 
-from tqdm import tqdm
 import argparse
 import asyncio
 
-from ankipandas import Collection
+_START = time.perf_counter()
+
+
+class ImportProfile:
+    """Record how long each top-level package takes to import, excluding the
+    packages it imports in turn."""
+
+    def __init__(self):
+        self.times = {}
+        self.stack = []
+
+    def __enter__(self):
+        self.original = builtins.__import__
+        builtins.__import__ = self.hook
+        return self
+
+    def __exit__(self, *exc):
+        builtins.__import__ = self.original
+
+    def hook(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return self.original(name, globals, locals, fromlist, level)
+
+        self.stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.perf_counter() - start
+            children = self.stack.pop()
+            package = name.partition(".")[0]
+            self.times[package] = self.times.get(package, 0) + elapsed - children
+            if self.stack:
+                self.stack[-1] += elapsed
+
+    def print(self):
+        total = time.perf_counter() - _START
+        print("STARTUP PROFILE:")
+        for package, seconds in sorted(
+            self.times.items(), key=lambda item: item[1], reverse=True
+        )[:15]:
+            print(f"{seconds * 1000:8.1f} ms  {package}")
+        print(f"{sum(self.times.values()) * 1000:8.1f} ms  imports in total")
+        print(f"{total * 1000:8.1f} ms  since the command line was loaded")
 
 
 class CLI(Interface):
@@ -23,6 +71,8 @@ class CLI(Interface):
         return resp == "y" or resp == "yes"
 
     def start_pbar(self, num):
+        from tqdm import tqdm
+
         self.pbar = tqdm(total=num)
 
     async def step_pbar(self):
@@ -32,9 +82,62 @@ class CLI(Interface):
         self.pbar.close()
 
 
+def audio_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog="ankichinese audio", description="Manage the shared pinyin audio store"
+    )
+    parser.add_argument(
+        "command",
+        choices=["prefetch"],
+        help="""PREFETCH: Download every missing syllable into the audio store""",
+    )
+    parser.add_argument(
+        "--audio-dir",
+        type=str,
+        default=default_audio_dir(),
+        help=f"Folder to store pinyin audio in (default: {default_audio_dir()})",
+    )
+    parser.add_argument(
+        "--syllables",
+        type=str,
+        default=None,
+        help="File with whitespace separated syllables to download, e.g. ma1 lv4 (default: all syllables)",
+    )
+    parser.add_argument(
+        "--requests-at-once",
+        "-r",
+        type=int,
+        default=8,
+        help="Maximum number of requests at once per audio source (default: 8)",
+    )
+    args = parser.parse_args(argv)
+
+    import audio
+
+    if args.syllables is None:
+        syllables = audio.all_syllables()
+    else:
+        with open(args.syllables, encoding="utf8") as f:
+            syllables = sorted(set(f.read().lower().split()))
+
+    interface = CLI()
+    store = audio.AudioStore(args.audio_dir)
+    errors = asyncio.run(
+        audio.prefetch(syllables, store, args.requests_at_once, interface)
+    )
+    for pinyin_tone, e in errors.items():
+        print(f"Error downloading audio for {pinyin_tone}: {e}")
+    print(f"Audio store: {store.audio_dir} ({len(store.manifest)} syllable(s))")
+    return 1 if errors else 0
+
+
 def cli():
+    if sys.argv[1:2] == ["audio"]:
+        return audio_cli(sys.argv[2:])
+
     parser = argparse.ArgumentParser(
-        description="Scrape ArchChinese for definitions and example words"
+        description="Scrape ArchChinese for definitions and example words",
+        epilog="Run 'ankichinese audio prefetch' to download all pinyin audio ahead of time",
     )
     parser.add_argument(
         "--export",
@@ -81,6 +184,12 @@ def cli():
         default=10,
         help="Maximum number of requests at once (default: 10)",
     )
+    parser.add_argument(
+        "--min-requests-at-once",
+        type=int,
+        default=1,
+        help="Minimum number of requests at once, the number adapts up to --requests-at-once (default: 1)",
+    )
     parser.add_argument(
         "--requests-per-second",
         "-rs",
@@ -88,9 +197,135 @@ def cli():
         default=5,
         help="Maximum number of requests per second (default: 5)",
     )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=4,
+        help="Number of attempts to look up a character after network errors before giving up (default: 4)",
+    )
+    parser.add_argument(
+        "--deadline",
+        type=float,
+        default=60,
+        help="Seconds allowed for each attempt to look up a character (default: 60)",
+    )
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=None,
+        help="Start a second download of a character once it is slower than this percentile of recent downloads, e.g. 95 (default: off)",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=default_cache_dir(),
+        help=f"Folder to cache downloaded pages in (default: {default_cache_dir()})",
+    )
+    parser.add_argument(
+        "--max-age",
+        type=float,
+        default=DEFAULT_MAX_AGE,
+        help=f"Number of days before a cached page is downloaded again, 0 to always download (default: {DEFAULT_MAX_AGE})",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=ENGINES,
+        default="auto",
+        help="""Page download engine (default: auto)
+        HTTP: Plain HTTP requests, no browser needed
+        BROWSER: Render every page in Chromium
+        AUTO: HTTP, falling back to Chromium when needed""",
+    )
+    parser.add_argument(
+        "--allow-host",
+        action="append",
+        default=[],
+        help="Host that browser pages may always load resources from, can be repeated",
+    )
+    parser.add_argument(
+        "--wait-until",
+        choices=WAIT_UNTIL,
+        default="domcontentloaded",
+        help="Browser page event to wait for before looking for results (default: domcontentloaded)",
+    )
+    parser.add_argument(
+        "--browser-contexts",
+        type=int,
+        default=1,
+        help="Number of browser contexts to spread pages across (default: 1)",
+    )
+    parser.add_argument(
+        "--page-max-uses",
+        type=int,
+        default=100,
+        help="Number of lookups before a browser page is replaced (default: 100)",
+    )
+    parser.add_argument(
+        "--audio-dir",
+        type=str,
+        default=default_audio_dir(),
+        help=f"Folder to store pinyin audio in (default: {default_audio_dir()})",
+    )
+    parser.add_argument(
+        "--parser",
+        choices=PARSERS,
+        default="lxml",
+        help="HTML parser, both give the same results (default: lxml)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=None,
+        help="Number of processes to parse pages in, 0 to parse in the main process (default: number of cores)",
+    )
+    parser.add_argument(
+        "--resume",
+        type=str,
+        default=None,
+        metavar="JOURNAL",
+        help="Journal of an interrupted run to continue, characters in it are not scraped again (default: start a new OUTPUT.journal.jsonl)",
+    )
+    parser.add_argument(
+        "--gzip",
+        action="store_true",
+        help="Compress CSV output into OUTPUT.csv.gz",
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="Add rows to an existing CSV file instead of replacing it",
+    )
+    parser.add_argument(
+        "--collection",
+        type=str,
+        default=None,
+        help="Anki collection.anki2 to update (default: the collection of the only Anki profile)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="In update mode, show which notes and fields would change without writing them",
+    )
+    parser.add_argument(
+        "--refresh-older-than",
+        type=float,
+        default=None,
+        metavar="DAYS",
+        help="In update mode, only update characters in the deck that were last updated more than DAYS days ago or by an older version (default: all)",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Write only notes and audio changed since the last build into OUTPUT.delta.apkg, tracked in OUTPUT.manifest.json",
+    )
+    parser.add_argument(
+        "--startup-profile",
+        action="store_true",
+        help="Print how long each imported package took to load before scraping",
+    )
     args = parser.parse_args()
     print(
-        f"OPTIONS:\nExport method: {args.export}\nInput file: {args.input}\nOutput name: {args.output}\nNumber of definitions: {args.definitions}\nNumber of examples: {args.examples}\nMax requests at once: {args.requests_at_once}\nmax requests per second: {args.requests_per_second}"
+        f"OPTIONS:\nExport method: {args.export}\nInput file: {args.input}\nOutput name: {args.output}\nNumber of definitions: {args.definitions}\nNumber of examples: {args.examples}\nMax requests at once: {args.requests_at_once}\nMin requests at once: {args.min_requests_at_once}\nmax requests per second: {args.requests_per_second}\nCache folder: {args.cache_dir}\nMax cache age: {args.max_age} day(s)\nEngine: {args.engine}"
     )
 
     chars = []  # List of characters to scrape
@@ -108,41 +343,82 @@ def cli():
         print("No characters found!")
         return
 
-    interface = CLI()
     export_mode = args.export
-    if export_mode == "csv":
-        results = asyncio.run(
-            scraper.main(
-                chars,
-                args.requests_at_once,
-                args.requests_per_second,
-                args.examples,
-                args.definitions,
-                interface,
-            )
+    with ImportProfile() as profile:
+        import scraper
+        import export
+    if args.startup_profile:
+        profile.print()
+
+    interface = CLI()
+    if args.resume and not os.path.isfile(args.resume):
+        interface.print(f"Journal to resume from not found: {args.resume}")
+        return 1
+    journal_path = args.resume or default_journal_path(args.output)
+    resume = args.resume is not None
+    if not resume and os.path.isfile(journal_path):
+        # The journal of an interrupted run is only replaced when asked to
+        resume = interface.confirm(
+            f"Found {journal_path} from an interrupted run. Resume from it? "
+            "(no starts over and replaces it)"
         )
-        export.gen_csv(
-            interface, results, os.path.join(os.getcwd(), args.output + ".csv")
+    max_age = args.max_age
+    if args.refresh_older_than is not None:
+        # Cached pages must not be older than the characters being refreshed
+        max_age = min(max_age, args.refresh_older_than)
+
+    def scrape(chars):
+        return scraper.scrape(
+            chars,
+            args.requests_at_once,
+            args.requests_per_second,
+            args.examples,
+            args.definitions,
+            interface,
+            cache_dir=args.cache_dir,
+            max_age=max_age,
+            engine=args.engine,
+            allowed_hosts=args.allow_host,
+            wait_until=args.wait_until,
+            num_contexts=args.browser_contexts,
+            page_max_uses=args.page_max_uses,
+            audio_dir=args.audio_dir,
+            parser=args.parser,
+            parse_workers=args.parse_workers,
+            journal_path=journal_path,
+            resume=resume,
+            min_at_once=args.min_requests_at_once,
+            max_attempts=args.max_attempts,
+            deadline=args.deadline,
+            hedge_percentile=args.hedge_percentile,
         )
-    elif export_mode == "anki":
-        results = asyncio.run(
-            scraper.main(
-                chars,
-                args.requests_at_once,
-                args.requests_per_second,
-                args.examples,
-                args.definitions,
-                interface,
-            )
+
+    if export_mode == "csv":
+        writer = export.CsvWriter(
+            interface,
+            os.path.join(os.getcwd(), args.output + ".csv"),
+            args.gzip,
+            args.append,
         )
-        export.gen_anki(
-            interface, results, os.path.join(os.getcwd(), args.output + ".apkg")
+        asyncio.run(export.write_stream(writer, scrape(chars)))
+        remove_journal(journal_path)
+    elif export_mode == "anki":
+        from manifest import default_manifest_path
+
+        output = os.path.join(os.getcwd(), args.output + ".apkg")
+        writer = export.AnkiWriter(
+            interface,
+            output,
+            args.audio_dir,
+            default_manifest_path(output) if args.incremental else None,
         )
+        asyncio.run(export.write_stream(writer, scrape(chars)))
+        remove_journal(journal_path)
     elif export_mode == "update":
-        col = Collection()
+        col = AnkiCollection(args.collection)
 
         # Get deck name
-        deck_names = col.cards.list_decks()
+        deck_names = col.deck_names()
         deck_name = None
         if len(deck_names) == 0:
             print("No decks found!")
@@ -155,12 +431,9 @@ def cli():
             while deck_name not in deck_names:
                 deck_name = input("Enter name of deck to update: ")
 
-        cards_in_deck = col.cards.merge_notes()
-        cards_in_deck = cards_in_deck[cards_in_deck["cdeck"].str.startswith(deck_name)]
-        notes_in_deck = col.notes[col.notes.nid.isin(cards_in_deck.nid)]
-
         # Get model name
-        model_names = notes_in_deck.list_models()
+        models = col.deck_models(deck_name)
+        model_names = list(models)
         model_name = None
         if len(model_names) == 0:
             print("No models found!")
@@ -173,12 +446,8 @@ def cli():
             while model_name not in model_names:
                 model_name = input("Enter name of model to update: ")
 
-        # Get fields in deck
-        fields = (
-            notes_in_deck.fields_as_columns()
-            .filter(regex="^nfld_", axis="columns")
-            .columns.str.replace("nfld_", "")
-        )
+        # Get fields in model
+        fields = col.field_names(models[model_name])
 
         # Fields that AnkiChinese would modify
         target_fields = [
@@ -210,20 +479,34 @@ def cli():
 
         existing_chars = []
         if interface.confirm("Also update characaters in deck?"):
-            existing_chars = notes_in_deck.fields_as_columns().nfld_Hanzi.to_list()
+            existing_chars = col.hanzi(deck_name)
+            if args.refresh_older_than is not None:
+                log = RefreshLog(refresh_log_path(col.path))
+                stale = log.stale(
+                    models[model_name],
+                    existing_chars,
+                    args.refresh_older_than,
+                    scraper.PARSER_VERSION,
+                )
+                log.close()
+                print(
+                    f"{len(stale)} of {len(existing_chars)} character(s) in deck "
+                    f"not updated in the last {args.refresh_older_than:g} day(s)"
+                )
+                existing_chars = stale
 
         chars.update(existing_chars)
-        results = asyncio.run(
-            scraper.main(
-                chars,
-                args.requests_at_once,
-                args.requests_per_second,
-                args.examples,
-                args.definitions,
-                interface,
-            )
+        results = asyncio.run(scraper.collect(scrape(chars)))
+        export.update_anki(
+            interface,
+            results,
+            col,
+            deck_name,
+            model_name,
+            args.audio_dir,
+            args.dry_run,
         )
-        export.update_anki(interface, results, col, deck_name, model_name)
+        remove_journal(journal_path)
         return 0
 
 
@@ -1,22 +1,134 @@
-import genanki
+import csv
+import functools
+import gzip
+import hashlib
+import itertools
+import json
 import os
-import pandas as pd
 import re as regex
+import shutil
+import sqlite3
+import tempfile
+import time
+import zipfile
+
+from ankidb import RefreshLog, refresh_log_path
+from audio import AudioStore
+from manifest import BuildManifest, file_hash
+from parsing import PARSER_VERSION
+
+
+_SOUND = regex.compile(r"\[sound:(.+?)\]")
+
+# Media types that are already compressed, deflating them gains nothing
+STORED_EXTENSIONS = {".mp3", ".ogg", ".jpg", ".jpeg", ".png", ".gif", ".webp", ".ttf"}
+
+# Note fields of the AnkiChinese model, also the columns of CSV exports
+FIELDS = [
+    "Hanzi",
+    "Traditional",
+    "Definition",
+    "Pinyin",
+    "Pinyin 2",
+    "Examples",
+    "Formation",
+    "Frequency Rank",
+    "Frequency Count",
+    "HSK",
+    "Audio",
+]
 
 
 def get_full_path(relative_path):
     return os.path.join(os.path.dirname(__file__), relative_path)
 
 
-def gen_csv(interface, results, output):
-    interface.print("Started generating CSV")
-    output_name = regex.search(r"[^\/]+(?=\.csv$)", output).group(0)
-    df = pd.DataFrame(results)
-    df.to_csv(output_name + ".csv", index=False, sep="\t")
-    interface.print("Finished generating " + output_name + ".csv")
+class CsvWriter:
+    """Write results to a tab separated file one row at a time.
+
+    Columns are always in FIELDS order. With compress the file is gzipped, and
+    with append rows are added to an existing file with the same columns.
+    """
+
+    def __init__(self, interface, output, compress=False, append=False):
+        self.interface = interface
+        self.output_name = regex.search(r"[^\/]+(?=\.csv$)", output).group(0)
+        self.file_name = self.output_name + (".csv.gz" if compress else ".csv")
+        self.compress = compress
+        self.append = append
+        self.file = None
+        self.writer = None
+
+    def open(self, mode):
+        if self.compress:
+            return gzip.open(self.file_name, mode + "t", newline="", encoding="utf8")
+        return open(self.file_name, mode, newline="", encoding="utf8")
+
+    def existing_header(self):
+        if not os.path.exists(self.file_name) or not os.path.getsize(self.file_name):
+            return None
+        with self.open("r") as f:
+            return next(csv.reader(f, delimiter="\t"), None)
+
+    def __enter__(self):
+        self.interface.print("Started generating CSV")
+        header = self.existing_header() if self.append else None
+        if header is not None and header != FIELDS:
+            raise ValueError(
+                f"Cannot append to {self.file_name}, its columns are {header}"
+            )
+        self.file = self.open("a" if self.append else "w")
+        self.writer = csv.DictWriter(
+            self.file,
+            fieldnames=FIELDS,
+            delimiter="\t",
+            lineterminator=os.linesep,
+        )
+        if header is None:
+            self.writer.writeheader()
+        return self
+
+    def write(self, data):
+        self.writer.writerow(data)
+        self.file.flush()
+
+    def __exit__(self, *exc_info):
+        self.file.close()
+        self.interface.print("Finished generating " + self.file_name)
+
+
+def gen_csv(interface, results, output, compress=False, append=False):
+    with CsvWriter(interface, output, compress, append) as writer:
+        for data in results:
+            writer.write(data)
+
+
+async def write_stream(writer, results):
+    """Write results from an async iterable as they arrive."""
+    with writer:
+        async for data in results:
+            writer.write(data)
 
 
+def model_hash(model) -> str:
+    """Hash the fields, templates and styling of a model."""
+    # genanki adds defaults to the field and template dicts when writing
+    content = json.dumps(
+        [
+            model.model_id,
+            [field["name"] for field in model.fields],
+            [[t["name"], t["qfmt"], t["afmt"]] for t in model.templates],
+            model.css,
+        ]
+    )
+    return hashlib.sha1(content.encode("utf8")).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
 def gen_model():
+    # genanki is only needed for decks, so CSV and update mode never load it
+    import genanki
+
     writing_front_html = open(get_full_path("card_template/writing/front.html"), "r")
     writing_front = writing_front_html.read()
     writing_front_html.close()
@@ -38,19 +150,7 @@ def gen_model():
     return genanki.Model(
         1354988330,
         "AnkiChinese",
-        fields=[
-            {"name": "Hanzi"},
-            {"name": "Traditional"},
-            {"name": "Definition"},
-            {"name": "Pinyin"},
-            {"name": "Pinyin 2"},
-            {"name": "Examples"},
-            {"name": "Formation"},
-            {"name": "Frequency Rank"},
-            {"name": "Frequency Count"},
-            {"name": "HSK"},
-            {"name": "Audio"},
-        ],
+        fields=[{"name": field} for field in FIELDS],
         templates=[
             {
                 "name": "AnkiChinese Writing",
@@ -69,6 +169,8 @@ def gen_model():
 
 
 def gen_note(model, data):
+    import genanki
+
     return genanki.Note(
         model=model,
         fields=[
@@ -88,116 +190,316 @@ def gen_note(model, data):
     )
 
 
-def add_audio(package, audio_path):
-    audio_files = os.listdir(audio_path)
-    for file in audio_files:
-        package.media_files.append(audio_path + "/" + file)
+def referenced_media(data) -> list:
+    """Return the file names of [sound:...] references in a note's fields."""
+    return [name for value in data.values() for name in _SOUND.findall(str(value))]
+
+
+def media_files(media_dir, names) -> tuple:
+    """Return the paths of the named files in media_dir, and the missing names."""
+    paths = [os.path.join(media_dir, name) for name in names]
+    missing = [os.path.basename(path) for path in paths if not os.path.isfile(path)]
+    return [path for path in paths if os.path.isfile(path)], missing
+
+
+def sync_media(paths, media_dir) -> tuple:
+    """Hardlink or copy media files into a collection's media folder.
+
+    Files that are already there with the same content are skipped. Different
+    files with the same name belong to the user and are left alone.
+
+    Returns:
+        tuple: Number of files added, number already present and the names of
+        files that differ from the ones in media_dir.
+    """
+    os.makedirs(media_dir, exist_ok=True)
+    added = present = 0
+    conflicts = []
+    for path in paths:
+        target = os.path.join(media_dir, os.path.basename(path))
+        if os.path.exists(target):
+            if os.path.getsize(target) == os.path.getsize(path) and (
+                file_hash(target) == file_hash(path)
+            ):
+                present += 1
+            else:
+                conflicts.append(os.path.basename(path))
+            continue
+        try:
+            os.link(path, target)
+        except OSError:
+            # Different file systems, or links are not supported
+            shutil.copyfile(path, target)
+        added += 1
+    return added, present, conflicts
+
+
+def write_package(package, file):
+    """Write a genanki package like Package.write_to_file, streaming into the zip.
+
+    The collection database is deflated, while media that is already compressed
+    is stored as is. Media files are copied into the archive in chunks, and the
+    media map is built up as they are added.
+    """
+    fd, db_path = tempfile.mkstemp(suffix=".anki2")
+    os.close(fd)
+    try:
+        conn = sqlite3.connect(db_path)
+        timestamp = time.time()
+        id_gen = itertools.count(int(timestamp * 1000))
+        package.write_to_db(conn.cursor(), timestamp, id_gen)
+        conn.commit()
+        conn.close()
+
+        with zipfile.ZipFile(file, "w") as outzip:
+            # The lowest level shrinks the database almost as much as the default
+            outzip.write(db_path, "collection.anki2", zipfile.ZIP_DEFLATED, 1)
+            media_map = {}
+            for idx, path in enumerate(package.media_files):
+                info = zipfile.ZipInfo.from_file(path, str(idx))
+                if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+                    info.compress_type = zipfile.ZIP_STORED
+                else:
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                with open(path, "rb") as src, outzip.open(info, "w") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+                media_map[str(idx)] = os.path.basename(path)
+            # Only one archive member can be open for writing at a time, so the
+            # map of numbered members to file names is written after the media
+            outzip.writestr("media", json.dumps(media_map), zipfile.ZIP_DEFLATED)
+    finally:
+        os.remove(db_path)
+
 
+def format_size(size) -> str:
+    for unit in ["B", "KiB", "MiB"]:
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
 
-def gen_anki(interface, results, output):
-    if interface:
-        interface.print("Started generating AnkiChinese deck")
-    output_name = regex.search(r"[^\/]+(?=\.apkg$)", output).group(0)
-    deck = genanki.Deck(2085137232, output_name)
-    model = gen_model()
-    for data in results:
-        deck.add_note(gen_note(model, data))
 
-    package = genanki.Package(deck)
-    add_audio(package, "ankichinese_audio")
-    package.media_files.append(get_full_path("card_template/_CNstrokeorder.ttf"))
-    package.write_to_file(output_name + ".apkg")
-    if interface:
-        interface.print("Finished generating " + output_name + ".apkg")
+class AnkiWriter:
+    """Add results to an AnkiChinese deck as they arrive.
 
+    The package is written on exit, including when scraping was interrupted,
+    so that partial results are not lost. Only audio referenced by the notes
+    is included.
 
-def update_anki(interface, results, col, deck_name: str, model_name: str):
+    With a build manifest, only notes and media that changed since the last
+    build are written to OUTPUT.delta.apkg, a small package to import over the
+    previous one. A full OUTPUT.apkg from an earlier build is left in place.
+    """
+
+    def __init__(self, interface, output, audio_dir=None, manifest_path=None):
+        self.interface = interface
+        self.output_name = regex.search(r"[^\/]+(?=\.apkg$)", output).group(0)
+        self.audio_dir = audio_dir
+        self.manifest_path = manifest_path
+        suffix = ".delta.apkg" if manifest_path else ".apkg"
+        self.package_name = self.output_name + suffix
+        self.manifest = None
+        self.unchanged = 0
+        self.deck = None
+        self.model = None
+        # Referenced media file names, a dict keeps the first-seen order
+        self.media = {}
+
+    def __enter__(self):
+        if self.interface:
+            self.interface.print("Started generating AnkiChinese deck")
+        import genanki
+
+        self.deck = genanki.Deck(2085137232, self.output_name)
+        self.model = gen_model()
+        if self.manifest_path:
+            self.manifest = BuildManifest(self.manifest_path, model_hash(self.model))
+        return self
+
+    def write(self, data):
+        import genanki
+
+        self.media.update(dict.fromkeys(referenced_media(data)))
+        if self.manifest is not None and not self.manifest.note_changed(
+            genanki.guid_for(data["Hanzi"]), [str(data[field]) for field in FIELDS]
+        ):
+            self.unchanged += 1
+            return
+        self.deck.add_note(gen_note(self.model, data))
+
+    def __exit__(self, *exc_info):
+        import genanki
+
+        audio_dir = AudioStore(self.audio_dir).audio_dir
+        media, missing = media_files(audio_dir, self.media)
+        media.append(get_full_path("card_template/_CNstrokeorder.ttf"))
+        if self.manifest is not None:
+            media = [path for path in media if self.manifest.media_changed(path)]
+        if self.interface and missing:
+            self.interface.print(
+                f"Warning: {len(missing)} referenced audio file(s) not found "
+                f"in {audio_dir}: {', '.join(missing)}"
+            )
+        if self.manifest is not None and not self.deck.notes and not media:
+            if self.interface:
+                self.interface.print(
+                    f"No changes since the last build of {self.output_name}"
+                )
+            return
+
+        write_package(genanki.Package(self.deck, media), self.package_name)
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.interface:
+            size = os.path.getsize(self.package_name)
+            unchanged = (
+                f", {self.unchanged} unchanged note(s) left out"
+                if self.manifest is not None
+                else ""
+            )
+            self.interface.print(
+                f"Finished generating {self.package_name} "
+                f"({len(self.deck.notes)} note(s), {len(media)} media file(s), "
+                f"{format_size(size)}{unchanged})"
+            )
+
+
+def gen_anki(interface, results, output, audio_dir=None, manifest_path=None):
+    with AnkiWriter(interface, output, audio_dir, manifest_path) as writer:
+        for data in results:
+            writer.write(data)
+
+
+class NoteDiff:
+    """Field by field differences between existing notes and scraped results.
+
+    Results are matched to notes by their Hanzi field. Fields the results do
+    not have are kept, or left empty in new notes.
+
+    Args:
+        field_names (list): Fields of the model, in order.
+        notes (list): (note id, field values) of the existing notes.
+        results (list): Scraped results.
+    """
+
+    def __init__(self, field_names, notes, results):
+        self.field_names = field_names
+        # Note id -> new field values of notes with at least one changed field
+        self.changed = {}
+        self.added = []
+        self.unchanged = 0
+        # Field name -> number of notes in which it changed
+        self.field_changes = dict.fromkeys(field_names, 0)
+        self.changed_fields = {}
+
+        index = field_names.index("Hanzi")
+        by_hanzi = {fields[index]: (nid, fields) for nid, fields in notes}
+        for data in results:
+            if data["Hanzi"] not in by_hanzi:
+                self.added.append([str(data.get(name, "")) for name in field_names])
+                continue
+            nid, old = by_hanzi[data["Hanzi"]]
+            new = [str(data.get(name, value)) for name, value in zip(field_names, old)]
+            changed = [name for name, a, b in zip(field_names, old, new) if a != b]
+            if not changed:
+                self.unchanged += 1
+                continue
+            self.changed[nid] = new
+            self.changed_fields[data["Hanzi"]] = changed
+            for name in changed:
+                self.field_changes[name] += 1
+
+    def __bool__(self):
+        return bool(self.changed or self.added)
+
+    def report(self, interface):
+        interface.print("Summary:")
+        interface.print(f"\tunchanged\t{self.unchanged}")
+        interface.print(f"\tchanged\t\t{len(self.changed)}")
+        interface.print(f"\tadded\t\t{len(self.added)}")
+        if self.changed:
+            interface.print("Changed fields:")
+            for name, count in self.field_changes.items():
+                if count:
+                    interface.print(f"\t{name}\t\t{count}")
+            interface.print("Notes changed:")
+            for hanzi, names in self.changed_fields.items():
+                interface.print(f"\t{hanzi}\t{', '.join(names)}")
+
+
+def update_anki(
+    interface,
+    results,
+    col,
+    deck_name: str,
+    model_name: str,
+    audio_dir=None,
+    dry_run=False,
+):
+    """Update notes of a model in a deck with results, and add new ones.
+
+    Only notes with a changed field are modified. With dry_run the changes are
+    reported but not applied. Otherwise referenced audio is copied into the
+    collection's media folder, and the characters are recorded in the
+    collection's refresh log, so that later updates can skip them while fresh.
+
+    Args:
+        col (AnkiCollection): Collection to update.
+    """
     interface.print(
         "Started updating\n\tdeck:\t\t" + deck_name + "\n\tmodel:\t\t" + model_name
     )
 
-    # Get notes from deck and model
-    cards = col.cards.merge_notes()
-    cards_in_deck = cards[cards["cdeck"].str.startswith(deck_name)]
-    notes_in_deck = col.notes[col.notes.nid.isin(cards_in_deck.nid)]
-    selec = notes_in_deck.query(f"nmodel == '{model_name}'").copy()
-
-    # Convert results to dataframe
-    res = pd.DataFrame(results)
-    res = res.add_prefix("nfld_")
-
-    # Merge existing notes and results
-    old = selec.fields_as_columns().copy()
-    old.set_index("nfld_Hanzi", inplace=True)
-    res.set_index("nfld_Hanzi", inplace=True)
-    old.update(res)
-    res.reset_index(inplace=True)
-    old.reset_index(inplace=True)
-    old = old.filter(regex="^nfld_", axis="columns")
-    # Update exisiting notes
-    selec["nflds"] = old.values.tolist()
-    col.notes.update(selec)
-
-    # Find and add new notes
-    selec.fields_as_columns(inplace=True)
-    new_notes = res[~res["nfld_Hanzi"].isin(selec["nfld_Hanzi"])]
-    # Include only columns that also exist in existing notes
-    diff_columns = old.columns.difference(new_notes.columns)
-    new_notes.loc[:, diff_columns] = ""
-    new_notes = new_notes[old.columns]
-    new_notes.columns = new_notes.columns.str.replace("nfld_", "")
-    col.notes.add_notes(
-        nmodel=model_name, nflds=new_notes.to_dict("records"), inplace=True
-    )
+    # Read only the notes of the model in the deck and its subdecks
+    model_id = col.deck_models(deck_name)[model_name]
+    field_names = col.field_names(model_id)
+    diff = NoteDiff(field_names, col.notes(deck_name, model_id), results)
+    diff.report(interface)
+    if dry_run:
+        interface.print("Dry run, nothing written")
+        col.close()
+        return
+
+    def finish():
+        # Notes left unchanged may still be missing their audio
+        names = {}
+        for data in results:
+            names.update(dict.fromkeys(referenced_media(data)))
+        store_dir = AudioStore(audio_dir).audio_dir
+        media, missing = media_files(store_dir, names)
+        if missing:
+            interface.print(
+                f"Warning: {len(missing)} referenced audio file(s) not found "
+                f"in {store_dir}: {', '.join(missing)}"
+            )
+        added, present, conflicts = sync_media(media, col.media_dir())
+        interface.print(
+            f"Added {added} audio file(s) to {col.media_dir()}, "
+            f"{present} already there"
+        )
+        if conflicts:
+            interface.print(
+                f"Warning: {len(conflicts)} audio file(s) not copied, a different "
+                f"file of the same name is already there: {', '.join(conflicts)}"
+            )
 
-    # Print changes
-    interface.print("Summary: ")
-    summary = col.summarize_changes(output="dict")
-    for key, value in summary.items():
-        interface.print(str(key))
-        for k, v in value.items():
-            interface.print("\t" + str(k) + "\t\t" + str(v))
+        log = RefreshLog(refresh_log_path(col.path))
+        log.record(model_id, [data["Hanzi"] for data in results], PARSER_VERSION)
+        log.close()
 
-    notes_added_nids = col.notes.loc[col.notes.was_added()].nid.tolist()
-    interface.print("\nNotes updated:")
-    interface.print(col.notes.loc[col.notes.was_modified(), "nflds"].to_string())
-    # interface.print("\nNotes added:")
-    # interface.print(col.notes.loc[notes_added_nids, "nflds"].to_string())
+    if not diff:
+        interface.print("Nothing to update")
+        finish()
+        col.close()
+        return
 
     if interface.confirm("Apply changes?"):
-        col.write(modify=True, add=True, delete=False)
-        if len(notes_added_nids) > 0:
-            col.cards.add_cards(notes_added_nids, deck_name, inplace=True)
-            col.write(add=True)
+        col.write_notes(model_id, deck_name, diff.changed, diff.added)
+        finish()
         interface.print("Finished updating " + deck_name + " " + model_name)
-
-        # Generate empty deck with audio files
-        audio_data = []
-        for audio_file in res.nfld_Audio.to_list():
-            audio_data.append(
-                {
-                    "Hanzi": "",
-                    "Traditional": "",
-                    "Definition": "",
-                    "Pinyin": "",
-                    "Pinyin 2": "",
-                    "Examples": "",
-                    "Formation": "",
-                    "HSK": "",
-                    "Frequency Rank": "",
-                    "Frequency Count": "",
-                    "Audio": audio_file,
-                }
-            )
-        gen_anki(
-            None, audio_data, os.path.join(os.getcwd(), "ankichinese_audio.apkg")
-        )
-        interface.print(
-            "Generated ankichinese_audio.apkg, import to Anki for deck audio"
-        )
     else:
         interface.print("Update canceled")
 
     interface.print("\n\n\n")
 
-    col.db.close()
+    col.close()
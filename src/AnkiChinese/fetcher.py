@@ -0,0 +1,266 @@
+import asyncio
+import re as regex
+import sys
+from contextlib import asynccontextmanager
+from typing import Optional
+from urllib.parse import urlsplit
+
+import httpx
+
+from options import ENGINES, WAIT_UNTIL
+
+DICTIONARY_URL = "https://www.archchinese.com/chinese_english_dictionary.html?find={}"
+
+# ArchChinese serves a reduced page to clients that do not look like a browser
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0 Safari/537.36",
+    "Accept-Language": "en-US,en;q=0.9",
+}
+
+# Resources that are never needed to read #charDef, #wordTable and #primaryPinyin
+BLOCKED_RESOURCE_TYPES = {"image", "media", "font", "stylesheet"}
+
+# Hosts serving the dictionary itself, anything else is third-party
+FIRST_PARTY_HOSTS = ["archchinese.com"]
+
+_WORD_TABLE = regex.compile(r"""id\s*=\s*["']?wordTable\b""")
+
+
+def has_word_table(content) -> bool:
+    return _WORD_TABLE.search(content) is not None
+
+
+def host_matches(host, hosts) -> bool:
+    """Return whether host is one of hosts or a subdomain of one of them."""
+    return any(host == other or host.endswith("." + other) for other in hosts)
+
+
+def playwright_errors() -> tuple:
+    """Return Playwright's Error and TimeoutError classes.
+
+    Playwright is only imported once the browser is needed, before that no
+    exception can come from it and empty tuples are returned.
+    """
+    module = sys.modules.get("playwright.async_api")
+    if module is None:
+        return (), ()
+    return module.Error, module.TimeoutError
+
+
+def is_overload(e) -> bool:
+    """Return whether an exception from fetching means the server is overloaded."""
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    _, timeout_error = playwright_errors()
+    return isinstance(
+        e,
+        (httpx.TimeoutException, httpx.NetworkError, asyncio.TimeoutError),
+    ) or isinstance(e, timeout_error)
+
+
+def is_transient(e) -> bool:
+    """Return whether fetching again might succeed after an exception.
+
+    Pages without results and parse errors fail the same way every time.
+    """
+    error, _ = playwright_errors()
+    return (
+        is_overload(e)
+        or isinstance(e, httpx.TransportError)
+        or isinstance(e, error)
+    )
+
+
+class PagePool:
+    """Bounded pool of reusable browser pages.
+
+    Pages are created on demand, spread round-robin across contexts, and closed
+    and replaced after max_uses navigations or after any error.
+
+    Args:
+        contexts (list): Browser contexts to open pages in.
+        size (int): Maximum number of open pages.
+        max_uses (int): Number of uses before a page is replaced.
+    """
+
+    def __init__(self, contexts, size, max_uses):
+        self.contexts = contexts
+        self.size = size
+        self.max_uses = max_uses
+        # Idle pages, None marks a free slot left by a closed page
+        self.idle = asyncio.Queue()
+        self.created = 0
+        self.opened = 0
+        self.uses = {}
+        self.recycled = 0
+
+    async def new_page(self):
+        context = self.contexts[self.opened % len(self.contexts)]
+        self.opened += 1
+        try:
+            page = await context.new_page()
+        except BaseException:
+            # Also on cancellation, or the pool would shrink for good
+            self.idle.put_nowait(None)
+            raise
+        self.uses[page] = 0
+        return page
+
+    async def acquire(self):
+        if self.idle.empty() and self.created < self.size:
+            self.created += 1
+            return await self.new_page()
+        page = await self.idle.get()
+        if page is None:
+            return await self.new_page()
+        return page
+
+    async def release(self, page, failed=False):
+        self.uses[page] += 1
+        if failed or self.uses[page] >= self.max_uses:
+            del self.uses[page]
+            self.recycled += 1
+            self.idle.put_nowait(None)
+            await page.close()
+        else:
+            self.idle.put_nowait(page)
+
+    @asynccontextmanager
+    async def page(self):
+        page = await self.acquire()
+        try:
+            yield page
+        except BaseException:
+            await self.release(page, failed=True)
+            raise
+        await self.release(page)
+
+
+class Fetcher:
+    """Download ArchChinese dictionary pages.
+
+    The http engine requests pages with a pooled HTTP client, the browser engine
+    renders them in Chromium, and the auto engine uses HTTP and falls back to
+    the browser for pages whose static HTML has no #wordTable. Chromium is only
+    launched once a page actually needs it.
+
+    Browser pages skip images, media, fonts, stylesheets and all third-party
+    requests unless their host is allowed.
+
+    Args:
+        engine (str): One of ENGINES.
+        requests_at_once (int): Maximum number of simultaneous connections.
+        allowed_hosts (list): Hosts whose requests are never blocked.
+        wait_until (str): One of WAIT_UNTIL, when to start looking for #wordTable.
+        num_contexts (int): Number of browser contexts to spread pages across.
+        page_max_uses (int): Number of lookups before a browser page is replaced.
+    """
+
+    def __init__(
+        self,
+        engine="auto",
+        requests_at_once=10,
+        allowed_hosts=None,
+        wait_until="domcontentloaded",
+        num_contexts=1,
+        page_max_uses=100,
+    ):
+        if engine not in ENGINES:
+            raise ValueError(f"Unknown engine {engine}, expected one of {ENGINES}")
+        if wait_until not in WAIT_UNTIL:
+            raise ValueError(
+                f"Unknown wait strategy {wait_until}, expected one of {WAIT_UNTIL}"
+            )
+        self.engine = engine
+        self.requests_at_once = requests_at_once
+        self.allowed_hosts = list(allowed_hosts or [])
+        self.wait_until = wait_until
+        self.num_contexts = num_contexts
+        self.page_max_uses = page_max_uses
+        self.blocked = 0
+        self.client = None
+        self.playwright = None
+        self.browser = None
+        self.pool = None
+        self.browser_lock = asyncio.Lock()
+        self.fallbacks = 0
+
+    async def __aenter__(self):
+        if self.engine != "browser":
+            self.client = httpx.AsyncClient(
+                headers=HEADERS,
+                follow_redirects=True,
+                timeout=30,
+                limits=httpx.Limits(
+                    max_connections=self.requests_at_once,
+                    max_keepalive_connections=self.requests_at_once,
+                ),
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.client is not None:
+            await self.client.aclose()
+        if self.browser is not None:
+            await self.browser.close()
+        if self.playwright is not None:
+            await self.playwright.stop()
+
+    async def get_pool(self) -> PagePool:
+        async with self.browser_lock:
+            if self.pool is None:
+                # Imported here so that the http engine never loads Playwright
+                from playwright.async_api import async_playwright
+
+                self.playwright = await async_playwright().start()
+                self.browser = await self.playwright.chromium.launch()
+                contexts = []
+                for _ in range(self.num_contexts):
+                    context = await self.browser.new_context()
+                    await context.route("**/*", self.handle_route)
+                    contexts.append(context)
+                self.pool = PagePool(
+                    contexts, self.requests_at_once, self.page_max_uses
+                )
+        return self.pool
+
+    async def handle_route(self, route):
+        request = route.request
+        host = urlsplit(request.url).hostname or ""
+        blocked = not host_matches(host, self.allowed_hosts) and (
+            request.resource_type in BLOCKED_RESOURCE_TYPES
+            or not host_matches(host, FIRST_PARTY_HOSTS)
+        )
+        if blocked:
+            self.blocked += 1
+            await route.abort()
+        else:
+            await route.continue_()
+
+    async def fetch_http(self, hanzi) -> Optional[str]:
+        """Return the static page for hanzi, or None if it has no #wordTable."""
+        r = await self.client.get(DICTIONARY_URL.format(hanzi))
+        r.raise_for_status()
+        return r.text if has_word_table(r.text) else None
+
+    async def fetch_browser(self, hanzi) -> str:
+        pool = await self.get_pool()
+        async with pool.page() as page:
+            await page.goto(DICTIONARY_URL.format(hanzi), wait_until=self.wait_until)
+            await page.wait_for_function(
+                "() => !!document.querySelector('#wordTable')"
+            )
+            return await page.content()
+
+    async def fetch(self, hanzi) -> str:
+        if self.engine == "browser":
+            return await self.fetch_browser(hanzi)
+
+        content = await self.fetch_http(hanzi)
+        if content is None:
+            if self.engine == "http":
+                raise ValueError("#wordTable not found in page")
+            self.fallbacks += 1
+            content = await self.fetch_browser(hanzi)
+        return content
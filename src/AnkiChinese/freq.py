@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+"""Character frequency table, stored as a prebuilt binary index.
+
+The index in data/char_freq.bin is generated from data/char_freq.tsv. Rebuild
+it after changing the TSV with:
+
+    python src/AnkiChinese/freq.py
+"""
+import array
+import bisect
+import csv
+import os
+import struct
+import sys
+
+DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
+TSV_PATH = os.path.join(DATA_DIR, "char_freq.tsv")
+INDEX_PATH = os.path.join(DATA_DIR, "char_freq.bin")
+
+# Magic, format version and number of characters, followed by three arrays of
+# that many little-endian uint32: sorted codepoints, ranks and counts
+HEADER = struct.Struct("<4sII")
+MAGIC = b"ACFI"
+VERSION = 1
+
+# Cached index, loaded on first lookup
+_INDEX = None
+
+
+def read_tsv(path=TSV_PATH) -> dict:
+    """Parse the frequency TSV into a mapping of character -> (rank, count)."""
+    freq_map = {}
+    with open(path, newline="", encoding="gb2312", errors="replace") as f:
+        reader = csv.reader(f, delimiter="\t")
+        for row in reader:
+            # Skip header/comment lines
+            if not row[0].strip().isdigit():
+                continue
+
+            rank = int(row[0].strip())
+            char = row[1].strip()
+            count = int(row[2].strip())
+            freq_map[char] = (rank, count)
+    return freq_map
+
+
+def to_uint32(values) -> array.array:
+    result = array.array("I", values)
+    if result.itemsize != 4:
+        raise ValueError("unsigned int is not 32 bits on this platform")
+    if sys.byteorder != "little":
+        result.byteswap()
+    return result
+
+
+class FrequencyIndex:
+    """Sorted codepoints with parallel ranks and counts, searched by bisection.
+
+    Args:
+        codepoints (array): Sorted codepoints of single characters.
+        ranks (array): Frequency rank of each character.
+        counts (array): Frequency count of each character.
+    """
+
+    def __init__(self, codepoints, ranks, counts):
+        self.codepoints = codepoints
+        self.ranks = ranks
+        self.counts = counts
+
+    @classmethod
+    def from_map(cls, freq_map) -> "FrequencyIndex":
+        items = sorted(
+            (ord(char), rank, count)
+            for char, (rank, count) in freq_map.items()
+            if len(char) == 1
+        )
+        return cls(
+            array.array("I", [item[0] for item in items]),
+            array.array("I", [item[1] for item in items]),
+            array.array("I", [item[2] for item in items]),
+        )
+
+    @classmethod
+    def load(cls, path=INDEX_PATH) -> "FrequencyIndex":
+        with open(path, "rb") as f:
+            data = f.read()
+        magic, version, size = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} frequency index")
+        arrays = []
+        for i in range(3):
+            start = HEADER.size + i * size * 4
+            values = array.array("I")
+            values.frombytes(data[start : start + size * 4])
+            if sys.byteorder != "little":
+                values.byteswap()
+            arrays.append(values)
+        return cls(*arrays)
+
+    def save(self, path=INDEX_PATH):
+        with open(path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, len(self.codepoints)))
+            for values in (self.codepoints, self.ranks, self.counts):
+                f.write(to_uint32(values).tobytes())
+
+    def __len__(self):
+        return len(self.codepoints)
+
+    def get(self, hanzi) -> tuple:
+        """Return (rank, count) of a character, or (None, None) if unknown."""
+        if not hanzi or len(hanzi) != 1:
+            return None, None
+        codepoint = ord(hanzi)
+        i = bisect.bisect_left(self.codepoints, codepoint)
+        if i == len(self.codepoints) or self.codepoints[i] != codepoint:
+            return None, None
+        return self.ranks[i], self.counts[i]
+
+
+def load_index() -> FrequencyIndex:
+    """Load the frequency index, falling back to the TSV if it was not built."""
+    global _INDEX
+    if _INDEX is not None:
+        return _INDEX
+
+    if os.path.exists(INDEX_PATH):
+        _INDEX = FrequencyIndex.load(INDEX_PATH)
+    elif os.path.exists(TSV_PATH):
+        _INDEX = FrequencyIndex.from_map(read_tsv(TSV_PATH))
+    else:
+        _INDEX = FrequencyIndex.from_map({})
+    return _INDEX
+
+
+def build_index(tsv_path=TSV_PATH, index_path=INDEX_PATH) -> FrequencyIndex:
+    """Regenerate the binary index from the TSV."""
+    index = FrequencyIndex.from_map(read_tsv(tsv_path))
+    index.save(index_path)
+    return index
+
+
+if __name__ == "__main__":
+    index = build_index()
+    print(f"Wrote {len(index)} character(s) to {INDEX_PATH}")
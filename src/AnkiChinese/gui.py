@@ -15,7 +15,9 @@ sys.path.insert(1, os.path.dirname(__file__))  # Allows python to find other mod
 import scraper
 import export
 from interface import Interface
-from ankipandas import Collection
+from cache import default_cache_dir, DEFAULT_MAX_AGE
+from journal import default_journal_path, remove_journal
+from ankidb import AnkiCollection, RefreshLog, refresh_log_path
 
 
 class Page(ttk.Frame):
@@ -84,6 +86,8 @@ class SpinboxField(ttk.Frame):
         ttk.Label(self, text=label).grid(row=0, column=0, padx=5, sticky=W)
         self.page = page
         self.label = label
+        self.min_val = min_val
+        self.max_val = max_val
         self.value = StringVar(page)
 
         if default_val != None:
@@ -115,7 +119,11 @@ class SpinboxField(ttk.Frame):
         ).grid(row=2, column=0, sticky=W)
 
     def val_field(self, new_val):
-        valid = new_val.isdigit() and 1 <= int(new_val) and int(new_val) <= 10
+        valid = (
+            new_val.isdigit()
+            and self.min_val <= int(new_val)
+            and int(new_val) <= self.max_val
+        )
         self.error_msg.set("" if valid else "Invalid " + self.label)
         self.valid = valid
         self.page.update_next_btn_state()
@@ -232,6 +240,39 @@ class ConfigPage(Page):
         )
         self.max_req_simul.grid(row=1, column=1)
 
+        # Page cache
+        self.max_age = SpinboxField(
+            self, adv_opt_frame, "Max cache age (days)", DEFAULT_MAX_AGE, 0, 365
+        )
+        self.max_age.grid(row=2, column=0)
+        cache_dir_frame = ttk.Frame(adv_opt_frame)
+        cache_dir_frame.grid(row=2, column=1, sticky=N)
+        ttk.Label(cache_dir_frame, text="Cache folder").grid(
+            row=0, column=0, padx=5, sticky=W
+        )
+        self.cache_dir = StringVar(self)
+        self.cache_dir.set(default_cache_dir())
+        ttk.Entry(cache_dir_frame, textvariable=self.cache_dir, width=15).grid(
+            row=1, column=0, padx=5
+        )
+        ttk.Button(cache_dir_frame, text="Browse", command=self.get_cache_dir).grid(
+            row=1, column=1, sticky=W
+        )
+
+        # Journal of an interrupted run to resume
+        resume_frame = ttk.Frame(adv_opt_frame)
+        resume_frame.grid(row=3, column=0, columnspan=2, sticky=W)
+        ttk.Label(resume_frame, text="Resume from journal (optional)").grid(
+            row=0, column=0, padx=5, sticky=W
+        )
+        self.resume = StringVar(self)
+        ttk.Entry(resume_frame, textvariable=self.resume, width=30).grid(
+            row=1, column=0, padx=5
+        )
+        ttk.Button(resume_frame, text="Browse", command=self.get_resume).grid(
+            row=1, column=1, sticky=W
+        )
+
     def import_chars(self):
         input_file = filedialog.askopenfilename()
         content = ""
@@ -255,6 +296,18 @@ class ConfigPage(Page):
         )
         self.output_entry.validate()
 
+    def get_cache_dir(self):
+        cache_dir = filedialog.askdirectory(initialdir=self.cache_dir.get())
+        if cache_dir:
+            self.cache_dir.set(cache_dir)
+
+    def get_resume(self):
+        resume = filedialog.askopenfilename(
+            filetypes=[("Journal", "*.journal.jsonl"), ("All files", "*")]
+        )
+        if resume:
+            self.resume.set(resume)
+
     # Validation helpers
     def val_chars(self):
         content = self.char_text_box.get()
@@ -284,6 +337,7 @@ class ConfigPage(Page):
             and self.num_defs.valid
             and self.max_req_ps.valid
             and self.max_req_simul.valid
+            and self.max_age.valid
         ):
             self.next_button.state(["!disabled"])
         else:
@@ -296,6 +350,9 @@ class ConfigPage(Page):
         controller.req_ps = int(self.max_req_ps.value.get())
         controller.num_ex = int(self.num_ex.value.get())
         controller.num_defs = int(self.num_defs.value.get())
+        controller.cache_dir = self.cache_dir.get()
+        controller.max_age = int(self.max_age.value.get())
+        controller.resume = self.resume.get() or None
         controller.output = self.output.get()
         controller.show_page("Generator")
 
@@ -340,6 +397,11 @@ class UpdateConfigPage(ConfigPage):
         ttk.Button(char_frame, text="Add existing chars", command=self.add_existing_chars).grid(
             row=3, column=0, columnspan=2, padx=5, sticky=EW
         )
+        # Existing chars updated more recently than this are not added, 0 adds all
+        self.refresh_age = SpinboxField(
+            self, char_frame, "Only chars not updated for (days)", 0, 0, 365
+        )
+        self.refresh_age.grid(row=4, column=0, columnspan=2, sticky=W)
 
         # Deck and Model
         deck_model_frame = ttk.Frame(basic_opt_frame)
@@ -375,38 +437,28 @@ class UpdateConfigPage(ConfigPage):
         ]
 
         # Get info for display
-        self.controller.col = Collection()
-        self.deck_names = self.controller.col.cards.list_decks()
+        self.controller.col = AnkiCollection()
+        self.deck_names = self.controller.col.deck_names()
         self.model_names = {}
+        self.model_ids = {}
         self.column_names = {}
-        self.notes_in_deck = {}
 
         # Decks
         for deck_name in self.deck_names:
             self.deck_tree.insert("", END, deck_name, text=deck_name)
             # Get model names
-            cards = self.controller.col.cards.merge_notes()
-            cards_in_deck = cards[cards["cdeck"].str.startswith(deck_name)]
-            self.notes_in_deck[deck_name] = self.controller.col.notes[
-                self.controller.col.notes.nid.isin(cards_in_deck.nid)
-            ]
-            self.model_names[deck_name] = self.notes_in_deck[deck_name].list_models()
+            models = self.controller.col.deck_models(deck_name)
+            self.model_names[deck_name] = list(models)
 
             # Insert models
-            for model_name in self.model_names[deck_name]:
+            for model_name, mid in models.items():
                 # Create unique ID in case multiple decks have same model
                 model_id = deck_name + "::" + model_name
                 self.deck_tree.insert(deck_name, END, model_id, text=model_name)
+                self.model_ids[model_id] = mid
 
-                # Get column/field names, intially prefixed with "nfld_"
-                self.column_names[model_id] = (
-                    self.notes_in_deck[deck_name]
-                    .copy()
-                    .query(f"nmodel == '{model_name}'")
-                    .fields_as_columns()
-                    .filter(regex="^nfld_", axis="columns")
-                    .columns.str.replace("nfld_", "")
-                )
+                # Get field names
+                self.column_names[model_id] = self.controller.col.field_names(mid)
 
                 # Insert fields
                 for column_name in self.column_names[model_id]:
@@ -458,11 +510,33 @@ class UpdateConfigPage(ConfigPage):
     def add_existing_chars(self):
         """ Add existing characters from selected deck to character text box.
         """
-        existing_chars = (
-            self.notes_in_deck[self.deck_tree.focus().split("::", 2)[0]]
-            .fields_as_columns()
-            .nfld_Hanzi.to_list()
-        )
+        col = self.controller.col
+        focus = self.deck_tree.focus()
+        deck_name = self.deck_tree.parent(focus) or focus
+        refresh_age = int(self.refresh_age.value.get())
+        if not refresh_age:
+            existing_chars = col.hanzi(deck_name)
+        else:
+            log = RefreshLog(refresh_log_path(col.path))
+            if focus in self.model_ids:
+                existing_chars = log.stale(
+                    self.model_ids[focus],
+                    col.hanzi(deck_name),
+                    refresh_age,
+                    scraper.PARSER_VERSION,
+                )
+            else:
+                # A deck is selected, check each of its models against its log
+                existing_chars = []
+                for model_id in self.deck_tree.get_children(deck_name):
+                    mid = self.model_ids[model_id]
+                    existing_chars += log.stale(
+                        mid,
+                        col.hanzi(deck_name, mid),
+                        refresh_age,
+                        scraper.PARSER_VERSION,
+                    )
+            log.close()
         cursor_index = self.char_text_box.index(INSERT)
         self.char_text_box.insert(cursor_index, "".join(existing_chars))
         self.val_chars()
@@ -502,13 +576,31 @@ class UpdateConfigPage(ConfigPage):
         self.update_next_btn_state()
         return valid
 
+    def update_next_btn_state(self):
+        if self.refresh_age.valid:
+            ConfigPage.update_next_btn_state(self)
+        else:
+            self.next_button.state(["disabled"])
+
     def update_controller(self):
         controller.export_mode = self.name
         controller.req_simul = int(self.max_req_simul.value.get())
         controller.req_ps = int(self.max_req_ps.value.get())
         controller.num_ex = int(self.num_ex.value.get())
         controller.num_defs = int(self.num_defs.value.get())
-        controller.output = self.deck_tree.focus().split("::", 2)
+        controller.cache_dir = self.cache_dir.get()
+        controller.max_age = int(self.max_age.value.get())
+        refresh_age = int(self.refresh_age.value.get())
+        if refresh_age:
+            # Cached pages must not be older than the characters being refreshed
+            controller.max_age = min(controller.max_age, refresh_age)
+        controller.resume = self.resume.get() or None
+        # Deck names can contain "::" themselves, so take the tree's parent
+        focus = self.deck_tree.focus()
+        controller.output = [
+            self.deck_tree.parent(focus),
+            self.deck_tree.item(focus, "text"),
+        ]
 
         controller.chars = self.char_text_box.get()
         controller.show_page("Generator")
@@ -659,6 +751,9 @@ class Controller:
         self.req_ps = None
         self.num_ex = None
         self.num_defs = None
+        self.cache_dir = None
+        self.max_age = DEFAULT_MAX_AGE
+        self.resume = None
         self.output = None
 
         # Create event loop for threading later
@@ -690,23 +785,46 @@ class Controller:
             filter(lambda char: "\u4e00" <= char <= "\u9fff", set(self.chars))
         )
 
-        results = await scraper.main(
+        if self.export_mode == "Update":
+            output = os.path.join(os.getcwd(), "ankichinese_update")
+        else:
+            output = self.output
+        if self.resume and not os.path.isfile(self.resume):
+            self.interface.print(f"Journal to resume from not found: {self.resume}")
+            return 1
+        journal_path = self.resume or default_journal_path(output)
+        resume = self.resume is not None
+        if not resume and os.path.isfile(journal_path):
+            # The journal of an interrupted run is only replaced when asked to
+            resume = self.interface.confirm(
+                f"Found {journal_path} from an interrupted run. Resume from it? "
+                "(Cancel starts over and replaces it)"
+            )
+        results = scraper.scrape(
             self.chars,
             self.req_simul,
             self.req_ps,
             self.num_ex,
             self.num_defs,
             self.interface,
+            cache_dir=self.cache_dir,
+            max_age=self.max_age,
+            journal_path=journal_path,
+            resume=resume,
         )
 
         if self.export_mode == "CSV":
-            export.gen_csv(self.interface, results, self.output)
+            writer = export.CsvWriter(self.interface, self.output)
+            await export.write_stream(writer, results)
         elif self.export_mode == "AnkiDeck":
-            export.gen_anki(self.interface, results, self.output)
+            writer = export.AnkiWriter(self.interface, self.output)
+            await export.write_stream(writer, results)
         elif self.export_mode == "Update":
             deck_name = self.output[0]
             model_name = self.output[1]
+            results = await scraper.collect(results)
             export.update_anki(self.interface, results, self.col, deck_name, model_name)
+        remove_journal(journal_path)
         return 0
 
 
@@ -0,0 +1,82 @@
+import asyncio
+from collections import deque
+from typing import Optional
+
+
+class Hedger:
+    """Start a duplicate of a request that is slower than most recent ones.
+
+    When a request runs longer than the given percentile of recent successful
+    latencies, a second copy is started. Whichever finishes first wins and the
+    other is cancelled. Each copy takes its own rate limit slot, and only the
+    time spent holding the slot is measured, so queued requests are not hedged.
+
+    Args:
+        percentile (float): Percentile of recent latencies after which to hedge,
+            None to never hedge.
+        window (int): Number of recent latencies to remember.
+        min_samples (int): Number of latencies needed before hedging.
+    """
+
+    def __init__(self, percentile=None, window=200, min_samples=20):
+        self.percentile = percentile
+        self.latencies = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.hedges = 0
+        self.wins = 0
+
+    def threshold(self) -> Optional[float]:
+        if self.percentile is None or len(self.latencies) < self.min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(len(latencies) - 1, int(len(latencies) * self.percentile / 100))
+        return latencies[index]
+
+    async def timed(self, slot, request, started=None):
+        async with slot():
+            if started is not None:
+                started.set()
+            start = asyncio.get_running_loop().time()
+            result = await request()
+            self.latencies.append(asyncio.get_running_loop().time() - start)
+            return result
+
+    async def run(self, slot, request):
+        """Await request() while holding slot(), hedging it with a second call
+        if it is slow."""
+        if self.percentile is None:
+            return await self.timed(slot, request)
+
+        started = asyncio.Event()
+        first = asyncio.ensure_future(self.timed(slot, request, started))
+        tasks = {first}
+        waiter = asyncio.ensure_future(started.wait())
+        try:
+            # The threshold counts from when the first copy got its slot
+            await asyncio.wait({first, waiter}, return_when=asyncio.FIRST_COMPLETED)
+            threshold = self.threshold()
+            if first.done() or threshold is None:
+                return await first
+            done, _ = await asyncio.wait(tasks, timeout=threshold)
+            if done:
+                return first.result()
+
+            self.hedges += 1
+            second = asyncio.ensure_future(self.timed(slot, request))
+            tasks.add(second)
+            error = None
+            while tasks:
+                done, tasks = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.wins += 1
+                        return task.result()
+                    error = error or task.exception()
+            raise error
+        finally:
+            waiter.cancel()
+            for task in tasks:
+                task.cancel()
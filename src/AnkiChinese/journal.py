@@ -0,0 +1,64 @@
+import json
+import os
+
+
+def default_journal_path(output) -> str:
+    """Return the journal path used for an output file name."""
+    base, ext = os.path.splitext(output)
+    if ext not in (".csv", ".apkg"):
+        base = output
+    return base + ".journal.jsonl"
+
+
+class Journal:
+    """Append-only JSON lines file of complete records, one per scraped character.
+
+    Every record is written as soon as it is scraped so that an interrupted run
+    can be resumed without scraping the same characters again. A partially
+    written last line from a crash is ignored. Only the characters are kept in
+    memory, apart from the records loaded to resume from.
+
+    Args:
+        path (str): Journal file.
+        resume (bool): Load records already in the file and append to it,
+            otherwise start a new journal.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        # Records loaded from an earlier run
+        self.records = {}
+        self.hanzi = set()
+        needs_newline = False
+        if resume:
+            with open(path, encoding="utf8") as f:
+                for line in f:
+                    needs_newline = not line.endswith("\n")
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.records[record["Hanzi"]] = record
+        self.hanzi.update(self.records)
+        self.file = open(path, "a" if resume else "w", encoding="utf8")
+        if needs_newline:
+            self.file.write("\n")
+
+    def __contains__(self, hanzi):
+        return hanzi in self.hanzi
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        self.hanzi.add(record["Hanzi"])
+
+    def close(self):
+        self.file.close()
+
+
+def remove_journal(path):
+    """Remove the journal of a run once its output is written."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,132 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+
+class AdaptiveLimiter:
+    """Additive increase, multiplicative decrease (AIMD) limit on requests at once.
+
+    The limit starts at floor and grows by one after every limit healthy
+    requests, up to ceiling. It halves, down to floor, when a request fails
+    with an overload error or when the smoothed latency rises to latency_factor
+    times the best smoothed latency seen. Only requests started after the last
+    decrease can cause another, so one burst of failures halves the limit once.
+    Request starts are also spaced to at most max_per_second.
+
+    Args:
+        floor (int): Lowest number of requests at once.
+        ceiling (int): Highest number of requests at once.
+        max_per_second (float): Highest number of requests started per second.
+        log (callable): Called with a message for every change of the limit.
+        is_overload (callable): Returns whether an exception means the server
+            is overloaded.
+        latency_factor (float): Latency inflation treated as overload.
+    """
+
+    def __init__(
+        self,
+        floor,
+        ceiling,
+        max_per_second,
+        log,
+        is_overload,
+        latency_factor=3,
+    ):
+        self.floor = max(1, floor)
+        self.ceiling = max(self.floor, ceiling)
+        self.interval = 1 / max_per_second if max_per_second else 0
+        self.log = log
+        self.is_overload = is_overload
+        self.latency_factor = latency_factor
+
+        self.limit = self.floor
+        self.in_flight = 0
+        self.successes = 0
+        self.next_start = 0
+        self.last_decrease = 0
+        self.latency = None
+        self.best_latency = None
+        self.condition = None
+
+    def now(self) -> float:
+        return asyncio.get_running_loop().time()
+
+    async def acquire(self) -> float:
+        """Wait for a free slot and return the time the request may start."""
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < self.limit)
+            self.in_flight += 1
+
+        now = self.now()
+        start = max(now, self.next_start)
+        self.next_start = start + self.interval
+        if start > now:
+            try:
+                await asyncio.sleep(start - now)
+            except BaseException:
+                # Cancelled before starting, give the slot back
+                await self.abandon()
+                raise
+        return start
+
+    async def abandon(self):
+        """Free the slot of a cancelled request without judging its latency."""
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    async def release(self, started, overloaded):
+        latency = self.now() - started
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * latency
+        if self.best_latency is None or self.latency < self.best_latency:
+            self.best_latency = self.latency
+
+        async with self.condition:
+            self.in_flight -= 1
+            if overloaded:
+                self.decrease(started, "request failed")
+            elif self.latency > self.latency_factor * self.best_latency:
+                self.decrease(started, f"latency rose to {self.latency:.1f}s")
+            else:
+                self.increase()
+            self.condition.notify_all()
+
+    def increase(self):
+        self.successes += 1
+        if self.successes >= self.limit and self.limit < self.ceiling:
+            self.successes = 0
+            self.limit += 1
+            self.log(
+                f"Raised to {self.limit} request(s) at once "
+                f"(latency {self.latency:.1f}s)"
+            )
+
+    def decrease(self, started, reason):
+        if started < self.last_decrease:
+            return
+        self.last_decrease = self.now()
+        self.successes = 0
+        # Forget the latency history, it was measured at a higher load
+        self.best_latency = self.latency
+        if self.limit > self.floor:
+            self.limit = max(self.floor, self.limit // 2)
+            self.log(f"Lowered to {self.limit} request(s) at once ({reason})")
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold a slot for the duration of one request."""
+        started = await self.acquire()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # Cancelled requests, such as hedge losers, say nothing about the server
+            await self.abandon()
+            raise
+        except BaseException as e:
+            await self.release(started, self.is_overload(e))
+            raise
+        await self.release(started, False)
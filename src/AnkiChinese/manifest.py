@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+
+from audio import write_atomic
+
+
+def default_manifest_path(output) -> str:
+    """Return the build manifest path used for an output file name."""
+    base, ext = os.path.splitext(output)
+    if ext != ".apkg":
+        base = output
+    return base + ".manifest.json"
+
+
+def file_hash(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class BuildManifest:
+    """Hashes of the notes and media in the packages built for one output.
+
+    Notes are keyed by GUID and media by file name. A manifest written for a
+    different model is ignored, so that every note is built again when the
+    card templates change.
+
+    Args:
+        path (str): Manifest file, created on save if missing.
+        model_hash (str): Hash of the model the notes are built with.
+    """
+
+    def __init__(self, path, model_hash):
+        self.path = path
+        self.model_hash = model_hash
+        self.notes = {}
+        self.media = {}
+        try:
+            with open(path, encoding="utf8") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return
+        if manifest.get("model") == model_hash:
+            self.notes = manifest["notes"]
+            self.media = manifest["media"]
+
+    def note_changed(self, guid, fields) -> bool:
+        """Record the fields of a note, return whether they differ from last time."""
+        digest = hashlib.sha1("\x1f".join(fields).encode("utf8")).hexdigest()
+        changed = self.notes.get(guid) != digest
+        self.notes[guid] = digest
+        return changed
+
+    def media_changed(self, path) -> bool:
+        """Record the content of a media file, return whether it is new or changed."""
+        name = os.path.basename(path)
+        digest = file_hash(path)
+        changed = self.media.get(name) != digest
+        self.media[name] = digest
+        return changed
+
+    def save(self):
+        manifest = {"model": self.model_hash, "notes": self.notes, "media": self.media}
+        write_atomic(self.path, json.dumps(manifest, sort_keys=True).encode("utf8"))
@@ -0,0 +1,27 @@
+"""Choices and defaults shared by the command line and the modules behind it.
+
+Only the standard library is imported here so that the command line can build
+its arguments without loading the scraper's dependencies.
+"""
+import os
+import sys
+
+# Ways to download dictionary pages, see fetcher.Fetcher
+ENGINES = ["http", "browser", "auto"]
+
+# Navigation events that page loads can wait for before checking for #wordTable
+WAIT_UNTIL = ["commit", "domcontentloaded", "load", "networkidle"]
+
+# Both parsers produce identical records, lxml is much faster
+PARSERS = ["lxml", "html5lib"]
+
+
+def default_audio_dir() -> str:
+    """Return the per-user folder that pinyin audio is stored in."""
+    if os.name == "nt":
+        base = os.environ.get("APPDATA", os.path.expanduser("~"))
+    elif sys.platform == "darwin":
+        base = os.path.expanduser("~/Library/Application Support")
+    else:
+        base = os.environ.get("XDG_DATA_HOME", os.path.expanduser("~/.local/share"))
+    return os.path.join(base, "ankichinese", "audio")
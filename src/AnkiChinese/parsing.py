@@ -0,0 +1,149 @@
+import re as regex
+
+from bs4 import BeautifulSoup
+from lxml import etree, html
+
+from options import PARSERS
+
+# Bump when parsing changes so that cached records are scraped again
+PARSER_VERSION = 1
+
+_SPACES = regex.compile(" +")
+_BRACKETS = regex.compile(r"[\[].*?[\]]")
+_PLAY_PINYIN = regex.compile(r'(?<=fn_playSinglePinyin\(")(.*)(?="\))')
+
+
+def clean_string(string) -> str:
+    return _SPACES.sub(" ", string.strip().replace("\n", ""))
+
+
+def basic_info(char_def_text) -> dict:
+    char_def = char_def_text.replace("\xa0", "").split("»")
+
+    # Get information in first box
+    details = dict()
+    for detail in char_def:
+        parts = detail.split(":")
+        if len(parts) >= 2:
+            details[parts[0].strip()] = clean_string(parts[1])
+
+    pinyin_list = details.get("Pinyin", "").split(", ")
+    info = {
+        "Traditional": clean_string(details.get("Traditional Form", "")),
+        "Definitions": details.get("Definition", "").split(", "),
+        "Pinyin": clean_string(pinyin_list[0]),
+        "Pinyin 2": clean_string(", ".join(pinyin_list[1:])),
+        "HSK": details.get("HSK Level", "None"),
+        "Formation": details.get("Formation", ""),
+    }
+    return info
+
+
+def example_word(word, ruby_list, definition_text) -> dict:
+    definitions = _BRACKETS.sub("", definition_text).split(", ")
+    return {"Word": word, "Pinyin": " ".join(ruby_list), "Definitions": definitions}
+
+
+def audio_key(onclick) -> str:
+    return _PLAY_PINYIN.search(onclick).group(0).lower()
+
+
+# html5lib parser, builds a BeautifulSoup tree of the whole page
+
+
+def scrape_basic_info(soup) -> dict:
+    return basic_info(soup.find("div", id="charDef").get_text())
+
+
+def scrape_example_words(soup) -> list:
+    word_table = soup.select_one("#wordPaneContent #wordTable")
+
+    ex_words = word_table.select(".word-container .char-effect:first-child")
+    ex_info = word_table.select(".col-md-7")
+
+    examples = []
+    for i in range(len(ex_words)):
+        ruby_list = []  # Pinyin to appear above word
+        for part in ex_info[i + 1].select("p>a>span"):
+            ruby_list.append(part.get_text())
+        examples.append(
+            example_word(
+                ex_words[i].text, ruby_list, ex_info[i + 1].select_one("p").get_text()
+            )
+        )
+
+    return examples
+
+
+def scrape_audio(soup) -> str:
+    return audio_key(
+        soup.select_one("#primaryPinyin a.arch-pinyin-font").get("onclick")
+    )
+
+
+# lxml parser, precompiled XPath equivalents of the selectors above
+
+
+def _has_class(name) -> str:
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+
+_CHAR_DEF = etree.XPath("//div[@id='charDef']")
+_WORD_TABLE = etree.XPath("//*[@id='wordPaneContent']//*[@id='wordTable']")
+_EX_WORDS = etree.XPath(
+    f".//*[{_has_class('word-container')}]"
+    f"//*[{_has_class('char-effect')}][not(preceding-sibling::*)]"
+)
+_EX_INFO = etree.XPath(f".//*[{_has_class('col-md-7')}]")
+_RUBY = etree.XPath(".//p/a/span")
+_EX_DEFINITION = etree.XPath(".//p")
+_AUDIO_LINK = etree.XPath(
+    f"//*[@id='primaryPinyin']//a[{_has_class('arch-pinyin-font')}]"
+)
+
+
+def scrape_basic_info_lxml(tree) -> dict:
+    return basic_info(_CHAR_DEF(tree)[0].text_content())
+
+
+def scrape_example_words_lxml(tree) -> list:
+    word_table = _WORD_TABLE(tree)[0]
+
+    ex_words = _EX_WORDS(word_table)
+    ex_info = _EX_INFO(word_table)
+
+    examples = []
+    for i in range(len(ex_words)):
+        ruby_list = [part.text_content() for part in _RUBY(ex_info[i + 1])]
+        examples.append(
+            example_word(
+                ex_words[i].text_content(),
+                ruby_list,
+                _EX_DEFINITION(ex_info[i + 1])[0].text_content(),
+            )
+        )
+
+    return examples
+
+
+def scrape_audio_lxml(tree) -> str:
+    return audio_key(_AUDIO_LINK(tree)[0].get("onclick"))
+
+
+def parse_word(r, hanzi, parser="lxml") -> dict:
+    """Parse a dictionary page into a complete, untruncated record."""
+    record = dict()
+    record["Hanzi"] = hanzi
+    if parser == "lxml":
+        tree = html.document_fromstring(r)
+        record.update(scrape_basic_info_lxml(tree))
+        record["Examples"] = scrape_example_words_lxml(tree)
+        record["Audio"] = scrape_audio_lxml(tree)
+    elif parser == "html5lib":
+        soup = BeautifulSoup(r, "html5lib")
+        record.update(scrape_basic_info(soup))
+        record["Examples"] = scrape_example_words(soup)
+        record["Audio"] = scrape_audio(soup)
+    else:
+        raise ValueError(f"Unknown parser {parser}, expected one of {PARSERS}")
+    return record
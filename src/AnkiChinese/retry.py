@@ -0,0 +1,25 @@
+import random
+
+
+class RetryPolicy:
+    """How often and how long to try looking up a character.
+
+    Args:
+        max_attempts (int): Number of attempts before a character fails.
+        deadline (float): Seconds allowed for each attempt.
+        base_delay (float): Seconds to wait after the first failed attempt,
+            doubling with each further attempt.
+        max_delay (float): Longest wait between attempts.
+    """
+
+    def __init__(self, max_attempts=4, deadline=60, base_delay=2, max_delay=60):
+        self.max_attempts = max(1, max_attempts)
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt) -> float:
+        """Return a jittered wait after the given failed attempt, counting from 1."""
+        return random.uniform(
+            0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        )
@@ -1,124 +1,17 @@
 import asyncio
-import aiometer
 import functools
-import re as regex
-import requests
-import os
-import csv
+from concurrent.futures import ProcessPoolExecutor
 from typing import Optional
-from bs4 import BeautifulSoup
-from playwright.async_api import async_playwright
 
-# Cached mapping from character -> (rank, count)
-_CHAR_FREQ_MAP = None
-
-
-def load_char_freq_map() -> dict:
-    """Load the character frequency file into a dict.
-
-    Returns a mapping of single-character string -> (int(rank), int(count)).
-    """
-    global _CHAR_FREQ_MAP
-    if _CHAR_FREQ_MAP is not None:
-        return _CHAR_FREQ_MAP
-
-    base_dir = os.path.dirname(__file__)
-    data_dir = os.path.join(base_dir, "data")
-    file_path = os.path.join(data_dir, "char_freq.tsv")
-
-    if not os.path.exists(file_path):
-        _CHAR_FREQ_MAP = {}
-        return {}
-
-    freq_map = {}
-    with open(file_path, newline="", encoding="gb2312", errors="replace") as f:
-        reader = csv.reader(f, delimiter="\t")
-        for row in reader:
-            # Skip header/comment lines
-            if not row[0].strip().isdigit():
-                continue
-
-            rank = int(row[0].strip())
-            char = row[1].strip()
-            count = int(row[2].strip())
-            freq_map[char] = (rank, count)
-
-    _CHAR_FREQ_MAP = freq_map
-    return _CHAR_FREQ_MAP
-
-
-def clean_string(string) -> str:
-    return regex.sub(" +", " ", string.strip().replace("\n", ""))
-
-
-def scrape_basic_info(soup, num_examples) -> dict:
-    char_def = soup.find("div", id="charDef").get_text().replace("\xa0", "").split("»")
-
-    # Get information in first box
-    details = dict()
-    for detail in char_def:
-        parts = detail.split(":")
-        if len(parts) >= 2:
-            details[parts[0].strip()] = clean_string(parts[1])
-
-    pinyin_list = details.get("Pinyin", "").split(", ")
-    info = {
-        "Traditional": clean_string(details.get("Traditional Form", "")),
-        "Definition": clean_string(
-            ", ".join(details.get("Definition", "").split(", ")[:num_examples])
-        ),
-        "Pinyin": clean_string(pinyin_list[0]),
-        "Pinyin 2": clean_string(", ".join(pinyin_list[1:])),
-        "HSK": details.get("HSK Level", "None"),
-        "Formation": details.get("Formation", ""),
-    }
-    return info
-
-
-def scrape_example_words(soup, num_examples, num_defs) -> str:
-    word_table = soup.select_one("#wordPaneContent #wordTable")
-
-    ex_words = word_table.select(".word-container .char-effect:first-child")
-    ex_info = word_table.select(".col-md-7")
-
-    examples = []
-    for i in range(min(num_examples, len(ex_words))):
-        word = ex_words[i].text
-        ruby_list = []  # Pinyin to appear above word
-        for part in ex_info[i + 1].select("p>a>span"):
-            ruby_list.append(part.get_text())
-        ruby_text = " ".join(ruby_list)
-        defn = ", ".join(
-            regex.sub(
-                r'[\[].*?[\]]', "", ex_info[i + 1].select_one("p").get_text()
-            ).split(", ")[:num_defs]
-        )
-
-        examples.append(word + "[" + ruby_text + "]: " + defn)
-
-    return clean_string("<br>".join(examples))
-
-
-def scrape_audio(soup) -> str:
-    pinyin_tone = (
-        regex.search(
-            r'(?<=fn_playSinglePinyin\(")(.*)(?="\))',
-            soup.select_one("#primaryPinyin a.arch-pinyin-font").get("onclick"),
-        )
-        .group(0)
-        .lower()
-    )
-
-    file_path = f"ankichinese_audio/{pinyin_tone}.mp3"
-    if not os.path.exists(file_path):
-        r = requests.get(f"https://cdn.yoyochinese.com/audio/pychart/{pinyin_tone}.mp3")
-        if r.status_code == 404:
-            r = requests.get(f"https://www.purpleculture.net/mp3/{pinyin_tone}.mp3")
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, "wb") as f:
-            f.write(r.content)
-
-    return f"[sound:{pinyin_tone}.mp3]"
+from cache import PageCache, RecordCache, DEFAULT_MAX_AGE
+from fetcher import Fetcher, is_overload, is_transient
+from audio import AudioDownloader, AudioStore
+from parsing import PARSER_VERSION, clean_string, parse_word
+from journal import Journal
+from limiter import AdaptiveLimiter
+from retry import RetryPolicy
+from hedge import Hedger
+from freq import load_index
 
 
 def get_frequency(hanzi) -> tuple:
@@ -129,68 +22,231 @@ def get_frequency(hanzi) -> tuple:
         int: The frequency rank of the character
         int: The frequency count of the character
     """
-    freq_map = load_char_freq_map()
-    if not hanzi or hanzi not in freq_map:
-        return None, None
-    return freq_map[hanzi]
+    return load_index().get(hanzi)
 
 
-def scrape_word(r, num_examples, num_defs, hanzi) -> dict:
-    soup = BeautifulSoup(r, "html5lib")
+def format_record(record, num_examples, num_defs) -> dict:
+    """Truncate a complete record and format it into output fields."""
+    examples = []
+    for example in record["Examples"][:num_examples]:
+        defn = ", ".join(example["Definitions"][:num_defs])
+        examples.append(example["Word"] + "[" + example["Pinyin"] + "]: " + defn)
 
     info = dict()
-    info["Hanzi"] = hanzi
-    info.update(scrape_basic_info(soup, num_examples))
-    info["Examples"] = scrape_example_words(soup, num_examples, num_defs)
-    freq_rank, freq_count = get_frequency(hanzi)
+    info["Hanzi"] = record["Hanzi"]
+    info["Traditional"] = record["Traditional"]
+    info["Definition"] = clean_string(
+        ", ".join(record["Definitions"][:num_examples])
+    )
+    info["Pinyin"] = record["Pinyin"]
+    info["Pinyin 2"] = record["Pinyin 2"]
+    info["HSK"] = record["HSK"]
+    info["Formation"] = record["Formation"]
+    info["Examples"] = clean_string("<br>".join(examples))
+    freq_rank, freq_count = get_frequency(record["Hanzi"])
     info["Frequency Rank"] = str(freq_rank) if freq_rank is not None else ""
     info["Frequency Count"] = str(freq_count) if freq_count is not None else ""
-    info["Audio"] = scrape_audio(soup)
-
+    info["Audio"] = f"[sound:{record['Audio']}.mp3]"
     return info
 
 
-async def fetch(interface, context, num_examples, num_defs, hanzi) -> Optional[dict]:
-    page = await context.new_page()
-    await page.goto(
-        f"https://www.archchinese.com/chinese_english_dictionary.html?find={hanzi}"
+async def parse(parse_pool, parser, content, hanzi) -> dict:
+    if parse_pool is None:
+        return parse_word(content, hanzi, parser)
+    # Parse in another process so other lookups keep going
+    return await asyncio.get_running_loop().run_in_executor(
+        parse_pool, parse_word, content, hanzi, parser
     )
-    await page.wait_for_function("() => !!document.querySelector('#wordTable')")
-    content = await page.content()
-    await page.close()
-    try:
-        return scrape_word(content, num_examples, num_defs, hanzi)
-    except Exception as e:
-        interface.print(f"Error scraping {hanzi}: {e}")
-        return None
 
 
-async def main(
+async def fetch(
+    fetcher,
+    limiter,
+    hedger,
+    retry,
+    failures,
+    downloader,
+    pages,
+    records,
+    journal,
+    parse_pool,
+    parser,
+    num_examples,
+    num_defs,
+    hanzi,
+) -> Optional[dict]:
+    def download():
+        # Only time spent holding a slot counts towards the deadline
+        return asyncio.wait_for(fetcher.fetch(hanzi), retry.deadline)
+
+    record = records.get(hanzi)
+    if record is None:
+        content = pages.get(hanzi)
+        for attempt in range(1, retry.max_attempts + 1):
+            fetched = content is None
+            try:
+                if fetched:
+                    content = await hedger.run(limiter.slot, download)
+                record = await parse(parse_pool, parser, content, hanzi)
+                break
+            except Exception as e:
+                # Download the page again on the next attempt
+                content = None
+                if attempt == retry.max_attempts or not is_transient(e):
+                    reason = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+                    failures[hanzi] = (reason, attempt)
+                    return None
+                await asyncio.sleep(retry.delay(attempt))
+        if fetched:
+            pages.put(hanzi, content)
+        records.put(hanzi, record)
+    if journal is not None:
+        journal.append(record)
+    downloader.schedule(record["Audio"])
+    return format_record(record, num_examples, num_defs)
+
+
+async def scrape(
     chars,
     requests_at_once,
     requests_per_second,
     num_examples,
     num_defs,
     interface,
-) -> list:
-    async with async_playwright() as p:
-        browser = await p.chromium.launch()
-        context = await browser.new_context()
-
-        interface.print("Started scraping")
-        interface.start_pbar(len(chars))
-        result_list = []
-        async with aiometer.amap(
-            functools.partial(fetch, interface, context, num_examples, num_defs),
-            chars,
-            max_at_once=requests_at_once,
-            max_per_second=requests_per_second,
-        ) as results:
-            async for data in results:
-                if data is not None:
-                    result_list.append(data)
-                await interface.step_pbar()
-        await browser.close()
-        interface.finish_pbar()
-        interface.print(f"Finished scraping {len(chars)} character(s)")
-        return result_list
+    cache_dir=None,
+    max_age=DEFAULT_MAX_AGE,
+    engine="auto",
+    allowed_hosts=None,
+    wait_until="domcontentloaded",
+    num_contexts=1,
+    page_max_uses=100,
+    audio_dir=None,
+    parser="lxml",
+    parse_workers=None,
+    journal_path=None,
+    resume=False,
+    min_at_once=1,
+    max_attempts=4,
+    deadline=60,
+    hedge_percentile=None,
+):
+    """Scrape chars and yield each result as soon as it is ready."""
+    journal = Journal(journal_path, resume) if journal_path else None
+    if journal is not None and resume:
+        interface.print(
+            f"Resuming from {journal_path}, "
+            f"{len(journal.records)} character(s) already scraped"
+        )
+        chars = [hanzi for hanzi in chars if hanzi not in journal]
+    elif journal is not None:
+        interface.print(f"Saving progress to {journal_path}")
+
+    pages = PageCache(cache_dir, max_age)
+    records = RecordCache(cache_dir, max_age, PARSER_VERSION)
+    # Cached characters skip the rate limit, only the rest are downloaded
+    limiter = AdaptiveLimiter(
+        min_at_once,
+        requests_at_once,
+        requests_per_second,
+        interface.print,
+        is_overload,
+    )
+    # Slow downloads get a second copy, which takes its own limiter slot
+    hedger = Hedger(hedge_percentile)
+    retry = RetryPolicy(max_attempts, deadline)
+    failures = {}
+    missing = {
+        hanzi
+        for hanzi in chars
+        if not records.contains(hanzi) and not pages.contains(hanzi)
+    }
+    # parse_workers of 0 parses on the event loop, None uses every core
+    parse_pool = ProcessPoolExecutor(parse_workers) if parse_workers != 0 else None
+    try:
+        async with Fetcher(
+            engine,
+            requests_at_once,
+            allowed_hosts,
+            wait_until,
+            num_contexts,
+            page_max_uses,
+        ) as fetcher, AudioDownloader(AudioStore(audio_dir)) as downloader:
+            interface.print("Started scraping")
+            interface.start_pbar(len(chars))
+            scrape_char = functools.partial(
+                fetch,
+                fetcher,
+                limiter,
+                hedger,
+                retry,
+                failures,
+                downloader,
+                pages,
+                records,
+                journal,
+                parse_pool,
+                parser,
+                num_examples,
+                num_defs,
+            )
+            if journal is not None:
+                for record in list(journal.records.values()):
+                    downloader.schedule(record["Audio"])
+                    yield format_record(record, num_examples, num_defs)
+            tasks = [asyncio.ensure_future(scrape_char(hanzi)) for hanzi in chars]
+            try:
+                for data in asyncio.as_completed(tasks):
+                    data = await data
+                    await interface.step_pbar()
+                    if data is not None:
+                        yield data
+            finally:
+                for task in tasks:
+                    task.cancel()
+            audio_errors = await downloader.wait()
+    finally:
+        if parse_pool is not None:
+            parse_pool.shutdown()
+        if journal is not None:
+            journal.close()
+        pages.close()
+        records.close()
+    for pinyin_tone, e in audio_errors.items():
+        interface.print(f"Error downloading audio for {pinyin_tone}: {e}")
+    interface.finish_pbar()
+    interface.print(
+        f"Finished scraping {len(chars)} character(s) "
+        f"({len(chars) - len(missing)} from cache)"
+    )
+    if failures:
+        interface.print(f"{len(failures)} character(s) failed:")
+        for hanzi, (reason, attempts) in failures.items():
+            interface.print(f"\t{hanzi}\t{reason} ({attempts} attempt(s))")
+    if limiter.latency is not None:
+        interface.print(
+            f"Finished at {limiter.limit} request(s) at once "
+            f"(latency {limiter.latency:.1f}s)"
+        )
+    if hedger.hedges:
+        interface.print(
+            f"Hedged {hedger.hedges} slow lookup(s), "
+            f"{hedger.wins} finished first"
+        )
+    if engine == "auto":
+        interface.print(f"{fetcher.fallbacks} lookup(s) fell back to the browser")
+    if fetcher.pool is not None:
+        interface.print(
+            f"Used {fetcher.pool.created} browser page(s), "
+            f"replaced {fetcher.pool.recycled} time(s)"
+        )
+    if fetcher.blocked:
+        interface.print(f"Blocked {fetcher.blocked} unneeded browser request(s)")
+
+
+async def collect(results) -> list:
+    return [data async for data in results]
+
+
+async def main(*args, **kwargs) -> list:
+    """Scrape chars and return all results, see scrape for arguments."""
+    return await collect(scrape(*args, **kwargs))